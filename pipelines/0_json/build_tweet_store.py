@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Copy the raw tweet dumps into a random-access tweet store (see _store.py),
+so single tweets or batches of tweets can be looked up by tweet_id without
+streaming the dumps.
+
+Input: raw tweet dumps
+
+Output: [storage] tweet_store directory with one record file per dump,
+        index.npy and files.json
+
+Spot checks: build_tweet_store.py --show TWEET_ID [TWEET_ID ...]
+'''
+
+import configparser
+import json
+import logging
+import time
+from argparse import ArgumentParser
+from itertools import islice
+from pathlib import Path
+
+import sys
+sys.path.append("../")
+
+from _helpers import *
+from _store import TweetStore, TweetStoreWriter
+
+# Setup logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logger.addHandler(ch)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build the random-access tweet store")
+    parser.add_argument("--show", nargs="+", metavar="TWEET_ID",
+                        help="Print stored tweets instead of building the store")
+    args = parser.parse_args()
+
+    # Load config
+    root = Path('../../')
+    Config = configparser.ConfigParser()
+    Config.read(str(root / 'config.cnf'))
+
+    input_dir = root / Config.get('input_files', 'raw_tweets')
+    store_dir = root / Config.get('storage', 'tweet_store', fallback='data/tweet_store/')
+
+    if args.show:
+        with TweetStore(store_dir) as store:
+            for tweet_id, tweet in zip(args.show, store.get_many(args.show)):
+                print(tweet_id, json.dumps(tweet) if tweet else "not found")
+        sys.exit(0)
+
+    writer = TweetStoreWriter(store_dir)
+    for infile in find_raw_files(input_dir):
+        start = time.time()
+        fmt, compression = raw_format(infile)
+        with open_raw(infile) as f:
+            stream = islice(f, 1, None) if fmt == 'csv' else f
+            n_tweets, n_bad = writer.add_file(raw_stem(infile), iter_raw_tweets(stream, fmt))
+        logger.info("{}: {} tweets ({} problematic) in {:.1f}s".format(
+            infile.name, n_tweets, n_bad, time.time() - start))
+
+    n_tweets = writer.close()
+    logger.info("Indexed {} distinct tweets".format(n_tweets))
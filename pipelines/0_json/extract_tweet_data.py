@@ -1,17 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Flatten the raw tweet dumps into one row per tweet.
+
+Raw dumps can be csv ([tweet_id, tweet] with header), tsv ("tweet_id<TAB>tweet",
+as delivered in .txt files) or jsonl, each optionally compressed with gzip,
+bz2 or xz. Compressed files are decompressed as a stream, never to disk.
+
+Uncompressed files are split into byte-range chunks that end on row
+boundaries, compressed streams into chunks of consecutive lines. Chunks are
+flattened in a process pool and merged back in file order, so the output is
+identical to a serial run.
+
+Dumps are processed incrementally: a checkpoint per output file records how
+far its dump was read (byte offset, or line count for compressed dumps) and
+the largest tweet_id and posted_on seen. When tweets are appended to a dump,
+only the new records are flattened and appended to its output. Compressed
+dumps only resume when the new tweets are appended as another gzip member
+(or bz2/xz stream) and the compressed bytes read so far stay the same; a
+dump that is compressed again as a whole is extracted from the start. The
+checkpoint also keeps the min/max posted_on of every chunk of the output, so
+later stages can skip chunks outside their time window (see [window]).
+
+Input: raw tweet dumps
+
+Output: ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
+         'quoted_status', 'in_reply_to', 'urls', 'is_truncated']
+
+posted_on is stored as int64 epoch seconds (UTC).
+'''
+
+import configparser
 import csv
+import io
+import logging
+import time
+from collections import deque
+from itertools import islice
+from argparse import ArgumentParser
+from multiprocessing import Pool
 from pathlib import Path
+
 import pandas as pd
-from dateutil.parser import parse
 from tqdm import tqdm
 
 import sys
 sys.path.append("../")
 
 from _helpers import *
+from _checkpoint import Checkpoint
+
+headers = TWEET_COLUMNS
+
+# Setup logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logger.addHandler(ch)
+
+
+def find_chunks(file, chunk_size, min_chunks=1, skip_header=True, start=None):
+    '''
+    Split a file into (start, end) byte ranges that end on row boundaries.
+
+    Chunks begin at byte `start`, or after the header row if `skip_header`
+    is set. Raw dumps hold one tweet per line (JSON escapes newlines inside
+    strings), so a line break is a row boundary.
+    '''
+    with open(str(file), "rb") as f:
+        if start is not None:
+            f.seek(start)
+        elif skip_header:
+            f.readline()
+        start = f.tell()
+        f.seek(0, 2)
+        size = f.tell()
+
+        if size <= start:
+            return []
+
+        n_chunks = max(min_chunks, -(-(size - start) // chunk_size))
+        step = max(1, (size - start) // n_chunks)
+
+        boundaries = [start]
+        for target in range(start + step, size, step):
+            if target <= boundaries[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline()
+            boundary = f.tell()
+            if boundary >= size:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def stream_chunks(file, chunk_size, skip_lines=0):
+    '''
+    Read a (compressed) raw dump as a stream and cut it into text chunks
+    of consecutive lines with roughly `chunk_size` characters each.
+    The first `skip_lines` lines (including the header) are skipped.
+
+    Yields (text, number of lines read so far).
+    '''
+    fmt, compression = raw_format(file)
+    if fmt == 'csv' and skip_lines == 0:
+        skip_lines = 1
+
+    with open_raw(file) as f:
+        for _ in islice(f, skip_lines):
+            pass
+        n_lines = skip_lines
+
+        lines, size = [], 0
+        for line in f:
+            lines.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                n_lines += len(lines)
+                yield "".join(lines), n_lines
+                lines, size = [], 0
+        if lines:
+            yield "".join(lines), n_lines + len(lines)
+
+
+def iter_tasks(file, chunk_size, min_chunks=1, position=None):
+    '''
+    Yield the (fmt, source, position) work items for one raw dump, starting
+    at `position`. `source` is a (file, start, end) byte range for plain files
+    and the chunk text for compressed ones; `position` is the byte offset
+    (plain) or line count (compressed) at the end of the chunk.
+    '''
+    fmt, compression = raw_format(file)
+    if compression:
+        for text, n_lines in stream_chunks(file, chunk_size, position or 0):
+            yield fmt, text, n_lines
+    else:
+        for start, end in find_chunks(file, chunk_size, min_chunks,
+                                      skip_header=(fmt == 'csv'), start=position):
+            yield fmt, (file, start, end), end
+
+
+def extract_chunk(task):
+    '''
+    Flatten all rows inside one chunk of a raw tweet dump.
+
+    Returns the CSV encoded output rows, the number of rows read, the
+    number of tweets that could not be loaded, the high-water marks and
+    the (min, max) posted_on of the chunk and its end position.
+    '''
+    fmt, source, position = task
+
+    if isinstance(source, tuple):
+        file, start, end = source
+        with open(str(file), "rb") as f:
+            f.seek(start)
+            source = f.read(end - start).decode("utf-8")
+
+    raw_tweets = list(iter_raw_tweets(io.StringIO(source, newline=''), fmt))
+    columns = flatten_tweets(raw_tweets)
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerows(tweet_rows(columns))
+
+    n_rows = len(raw_tweets)
+    n_bad = n_rows - len(columns['row'])
+
+    marks, ranges = {}, {}
+    if len(columns['row']) > 0:
+        marks['tweet_id'] = max(int(tweet_id) for tweet_id in columns['tweet_id'])
+        marks['posted_on'] = int(columns['posted_on'].max())
+        ranges['posted_on'] = (int(columns['posted_on'].min()), marks['posted_on'])
+
+    return out.getvalue(), n_rows, n_bad, marks, ranges, position
+
+
+def ordered_imap(pool, func, tasks, window):
+    '''
+    Like Pool.imap, but keeps at most `window` tasks in flight so
+    streamed chunks are not all read into memory ahead of the workers.
+    '''
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def extract_file(infile, checkpoint, pool=None, chunk_size=64 * 2**20, min_chunks=1,
+                 window=4):
+    '''
+    Flatten the records of one raw tweet file that come after its last
+    checkpoint. Chunks are processed by `pool` if given, with at most
+    `window` chunks in flight, and always appended to the output in file
+    order, with a commit after each chunk.
+    '''
+    fmt, compression = raw_format(infile)
+    # compressed dumps are checkpointed by line count, their signature
+    # covers the compressed bytes: appended members/streams leave it intact,
+    # recompressing the dump invalidates it and the dump is extracted again
+    size = infile.stat().st_size
+    input_size = size if compression else None
+
+    checkpoint.open_output()
+    position = checkpoint.input_offset
+    tasks = iter_tasks(infile, chunk_size, min_chunks, position)
+
+    if pool:
+        results = ordered_imap(pool, extract_chunk, tasks, window)
+    else:
+        results = map(extract_chunk, tasks)
+
+    total = checkpoint.rows
+    n_rows, n_bad = 0, 0
+    for text, rows, bad, marks, ranges, position in tqdm(results, unit="chunk"):
+        checkpoint.outf.write(text)
+        checkpoint.mark(**marks)
+        if ranges:
+            checkpoint.zone(**ranges)
+        n_rows += rows
+        n_bad += bad
+        checkpoint.commit(position, total + n_rows, input_size)
+
+    if not compression:
+        position = size
+    checkpoint.finish(position or 0, total + n_rows, input_size)
+
+    return n_rows, n_bad
+
 
 if __name__ == "__main__":
-    headers = ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
-               'quoted_status', 'in_reply_to', 'urls', 'is_truncated']
+    parser = ArgumentParser(description="Flatten raw tweet dumps")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of worker processes (default from config)")
+    parser.add_argument("--chunk-mb", type=int, default=None,
+                        help="Approximate chunk size in MB (default from config)")
+    args = parser.parse_args()
 
     # Load config
     logger.info('Loading configuration.')
@@ -19,66 +252,37 @@ if __name__ == "__main__":
     Config = configparser.ConfigParser()
     Config.read(str(root / 'config.cnf'))
 
+    workers = args.workers or Config.getint('extraction', 'workers', fallback=1)
+    chunk_mb = args.chunk_mb or Config.getint('extraction', 'chunk_mb', fallback=64)
+
     # Load files from disk
-    queries = root / Config.get('input_files', 'raw')
     input_dir = root / Config.get('input_files', 'raw_tweets')
 
     output_dir = Path("temp/")
 
-    queries = load_queries(str(queries))
+    pool = Pool(workers) if workers > 1 else None
 
-    files = input_dir.glob("*.csv")
+    files = find_raw_files(input_dir)
     for infile in files:
-        outfile = output_dir / infile.name
-        if outfile.exists():
-            print("{} already exists. skipping".format(outfile))
+        outfile = output_dir / (raw_stem(infile) + ".csv")
+        checkpoint = Checkpoint(infile, outfile, headers)
+        if checkpoint.done:
+            print("{} is up to date. skipping".format(outfile))
             continue
 
-        query_name = infile.name.split(".")[0]
-        row_count = queries.loc[queries['query'] == query_name, "found_tweets"].iloc[0]
-
-        print("Collecting {}".format(infile.name))
-        with open(str(infile), "r") as inf:
-            with open(str(outfile), "a") as outf:
-                reader = csv.reader(inf)
-                next(reader, None)
-
-                writer = csv.writer(outf)
-                writer.writerow(headers)
-
-                for row in tqdm(reader, total=row_count):
-                    tweet = load_json(row[1])
-
-                    if not tweet:
-                        continue
-
-                    tweet_id = str(tweet['id_str'])
-                    posted_on = str(parse(tweet['created_at'], ignoretz=True))
-                    user_id = str(tweet['user']['id_str'])
-                    is_truncated = str(tweet['truncated'])
-
-                    urls = get_tweet_urls(tweet)
-                    if len(urls) > 0:
-                        urls = str(urls)
-                    else:
-                        urls = None
-
-                    if 'retweeted_status' in tweet:
-                        retweeted_status = str(tweet['retweeted_status']['id_str'])
-                    else:
-                        retweeted_status = None
-
-                    if 'quoted_status_id_str' in tweet:
-                        quoted_status = str(tweet['quoted_status_id_str'])
-                    else:
-                        quoted_status = None
-
-                    if tweet['in_reply_to_status_id_str']:
-                        in_reply_to = str(tweet['in_reply_to_status_id_str'])
-                    else:
-                        in_reply_to = None
+        logger.info("Collecting {} with {} worker(s)".format(infile.name, workers))
+        if checkpoint.input_offset is not None:
+            logger.info("Resuming after {} rows ({})".format(checkpoint.rows, checkpoint.marks))
+        start = time.time()
+        with checkpoint:
+            n_rows, n_bad = extract_file(infile, checkpoint, pool,
+                                         chunk_size=chunk_mb * 2**20, min_chunks=workers,
+                                         window=2 * workers)
+        elapsed = time.time() - start
 
-                    row = [tweet_id, posted_on, user_id, retweeted_status,
-                           quoted_status, in_reply_to, urls, is_truncated]
+        logger.info("{}: {} new rows ({} problematic) in {:.1f}s ({:.0f} rows/s)".format(
+            infile.name, n_rows, n_bad, elapsed, n_rows / max(elapsed, 1e-9)))
 
-                    writer.writerow(row)
+    if pool:
+        pool.close()
+        pool.join()
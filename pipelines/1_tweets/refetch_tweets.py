@@ -5,7 +5,9 @@
 Remove at the end...
 
 1. Read original tweet JSONs.
-2. Filter time window.
+2. Filter time window ([window] in the config). Chunks of the input that
+   lie outside of it, according to the zone map of the extraction, are
+   skipped without being parsed.
 3. Re-fetch truncated tweets.
 
 Input: ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
@@ -14,126 +16,157 @@ Input: ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
 Output: ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
           'quoted_status', 'in_reply_to', 'urls', 'is_truncated',
           'refetched', 'error']
+
+and the tweet_urls table: ['tweet_id', 'url_index', 'url', 'expanded_url', 'venue']
 """
 
 import configparser
 import csv
-from datetime import datetime
 from pathlib import Path
 
 import pandas as pd
-import requests
 import tweepy
-from dateutil.parser import parse
 from tqdm import tqdm
 
 import sys
 sys.path.append("../")
 
 from _helpers import *
+from _twitter import *
+from _checkpoint import Checkpoint, load_zones, skip_ranges
 
 tqdm.pandas()
 
+headers = ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
+           'quoted_status', 'in_reply_to', 'urls', 'is_truncated',
+           'refetched', 'error']
 
-def refetch_tweet(tweet_id):
-    error = None
-
-    try:
-        status = api.get_status(tweet_id, tweet_mode='extended')
-        tweet = status._json
-    except tweepy.TweepError as e:
-        error = str(e)
-        return None, True, False, error
-
-    if tweet_id != tweet['id_str']:
-        return None, True, False, "Fetched wrong tweet: {}".format(tweet['id_str'])
-
-    urls = get_tweet_urls(tweet)
-    if len(urls) > 0:
-        urls = json.dumps(urls)
-    else:
-        urls = None
 
-    return urls, False, True, error
+def write_batch(writer, rows, results):
+    '''
+    Fill in the refetch results of a batch and write its rows in order
+    '''
+    for row in rows:
+        if row[0] in results:
+            urls, truncated, refetched, error = results[row[0]]
+            row[headers.index('urls')] = urls
+            row[headers.index('is_truncated')] = truncated
+            row.append(refetched)
+            row.append(error)
+        else:
+            row.append(None)
+            row.append(None)
+        writer.writerow(row)
 
 
 if __name__ == "__main__":
-    min_date = datetime(2016, 9, 1)
-    max_date = datetime(2017, 9, 1)
-
-    headers = ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
-               'quoted_status', 'in_reply_to', 'urls', 'is_truncated',
-               'refetched', 'error']
-
     # Load config
     root = Path('../../')
     Config = configparser.ConfigParser()
     Config.read(str(root / 'config.cnf'))
 
+    min_epoch, max_epoch = time_window(Config)
+
     queries = root / Config.get('input_files', 'queries')
     queries = load_queries(str(queries))
 
-    tweets_dir = Path("temp/")
+    # flattened tweets of 0_json/extract_tweet_data.py
+    tweets_dir = root / "pipelines/0_json/temp/"
     input_files = tweets_dir.glob("*.csv")
 
     output_dir = root / Config.get('output_files', 'tweets')
+    tweet_urls = root / Config.get('output_files', 'tweet_urls')
 
     # Setup Twitter API
-    consumer_key = Config.get('twitter_keys', 'consumer_key')
-    consumer_secret = Config.get('twitter_keys', 'consumer_secret')
-    access_token = Config.get('twitter_keys', 'access_token')
-    access_token_secret = Config.get('twitter_keys', 'access_token_secret')
+    api_url = Config.get('refetch', 'api_url', fallback='')
+    if api_url:
+        # e.g. a local mock server
+        client = HTTPClient(api_url)
+    else:
+        consumer_key = Config.get('twitter_keys', 'consumer_key')
+        consumer_secret = Config.get('twitter_keys', 'consumer_secret')
+        access_token = Config.get('twitter_keys', 'access_token')
+        access_token_secret = Config.get('twitter_keys', 'access_token_secret')
+
+        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        auth.set_access_token(access_token, access_token_secret)
+        # set up access to the Twitter API, rate limits are handled by RateWindow
+        api = tweepy.API(auth)
+        client = TweepyClient(api)
 
-    auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-    auth.set_access_token(access_token, access_token_secret)
-    # set up access to the Twitter API
-    api = tweepy.API(auth, wait_on_rate_limit=True,
-                     wait_on_rate_limit_notify=True)
+    window = RateWindow(calls=Config.getint('refetch', 'window_calls', fallback=900),
+                        period=Config.getint('refetch', 'window_minutes', fallback=15) * 60)
 
     # Iterate over available newspapers
     for infile in input_files:
-        outfile = out_dir / infile.name
-        if outfile.exists():
-            print("{} already exists. skipping".format(outfile))
+        outfile = output_dir / infile.name
+        checkpoint = Checkpoint(infile, outfile, headers)
+        if checkpoint.done:
+            print("{} is up to date. skipping".format(outfile))
             continue
 
         q = infile.name.split(".")[0]
         row_count = queries.loc[queries['query'] == q, "found_tweets"].iloc[0]
 
         print("Collecting {}".format(infile.name))
-        with open(str(infile), "r") as inf:
-            with open(str(outfile), "a") as outf:
-                reader = csv.reader(inf)
-                next(reader, None)
-
-                writer = csv.writer(outf)
-                writer.writerow(headers)
-
-                for row in tqdm(reader, total=row_count):
-                    posted_on = parse(row[headers.index('posted_on')], ignoretz=True)
-
-                    if (posted_on >= min_date) & (posted_on < max_date):
-                        if row[headers.index('is_truncated')]:
-                            urls, truncated, refetched, error = refetch_tweet(row[0])
-                            row[headers.index('urls')] = urls
-                            row[headers.index('is_truncated')] = truncated
-                            row.append(refetched)
-                            row.append(error)
-                        else:
-                            row.append(None)
-                            row.append(None)
-
-                        writer.writerow(row)
-
-    temp_files = list(out_dir.glob("*.csv"))
+        if checkpoint.marks:
+            print("Resuming after tweet {tweet_id}".format(**checkpoint.marks))
+        # chunks of the extracted tweets that are entirely outside of the window
+        zones = load_zones(infile)
+        skip = skip_ranges(zones, 'posted_on', min_epoch, max_epoch)
+        if skip:
+            print("Skipping {} of {} chunks outside of the time window".format(
+                len(skip), len(zones)))
+
+        with checkpoint:
+            reader, writer = checkpoint.open(skip=skip)
+
+            # rows are buffered until LOOKUP_BATCH_SIZE truncated tweets
+            # can be refetched with a single lookup, and committed after
+            # each lookup so a restart doesn't request them again
+            rows, truncated_ids = [], []
+            for row in tqdm(reader, total=row_count, initial=checkpoint.rows):
+                posted_on = epoch_value(row[headers.index('posted_on')])
+
+                if posted_on is not None and min_epoch <= posted_on < max_epoch:
+                    row[headers.index('posted_on')] = str(posted_on)
+                    rows.append(row)
+                    checkpoint.mark(tweet_id=int(row[0]), posted_on=posted_on)
+                    if row[headers.index('is_truncated')] == 'True':
+                        truncated_ids.append(row[0])
+
+                    if len(truncated_ids) == LOOKUP_BATCH_SIZE:
+                        write_batch(writer, rows, refetch_batch(client, truncated_ids, window))
+                        checkpoint.commit()
+                        rows, truncated_ids = [], []
+
+            results = refetch_batch(client, truncated_ids, window) if truncated_ids else {}
+            write_batch(writer, rows, results)
+            checkpoint.finish()
+
+    temp_files = list(output_dir.glob("*.csv"))
 
     dfs = []
     for file in tqdm(temp_files):
-        df = load_tweets(file)
+        df = load_tweets(file, index_col=None)
         df['venue'] = file.name.split("/")[-1].split(" ")[0]
         dfs.append(df)
     tweets = pd.concat(dfs)
-    tweets.drop("Unnamed: 0", inplace=True, axis=1)
-    tweets.reset_index(drop=True)
+    tweets.drop("Unnamed: 0", inplace=True, axis=1, errors="ignore")
+    tweets.reset_index(drop=True, inplace=True)
     tweets.index.name = "id"
-    tweets.to_csv(output_dir)
+
+    table_format = Config.get('storage', 'format', fallback='parquet')
+    if table_format != 'csv':
+        save_table(compact_tweets(tweets.copy()), output_dir, table_format)
+    if table_format == 'csv' or Config.getboolean('storage', 'export_csv', fallback=False):
+        # csv tweet tables store posted_on as epoch seconds
+        save_table(tweets.assign(posted_on=to_epoch(tweets['posted_on'])), output_dir, 'csv')
+
+    # one row per URL, so the URL stages never decode the urls lists
+    urls = explode_urls(tweets)
+    urls.index.name = "id"
+    if table_format != 'csv':
+        save_table(urls.assign(tweet_id=ids_to_int(urls['tweet_id'])), tweet_urls, table_format)
+    if table_format == 'csv' or Config.getboolean('storage', 'export_csv', fallback=False):
+        save_table(urls, tweet_urls, 'csv')
@@ -2,26 +2,101 @@
 # -*- coding: utf-8 -*-
 
 import configparser
-import json
+import csv
+import os
 import sys
-from os import listdir
-from os.path import isfile, join
+import uuid
 from pathlib import Path
-from pprint import pprint
 
-import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
-import seaborn as sns
-import urltools
 from tqdm import tqdm
 
 sys.path.append("../")
 from _helpers import *
+from _checkpoint import LineReader, input_changed, input_signature, load_journal, save_journal
+from _url_cache import open_clean_cache
 
 tqdm.pandas()
 
 
+def read_results(file, offset=None, chunksize=PARQUET_ROW_GROUP_SIZE):
+    '''
+    Temporary results of get_relevant_urls.py, starting at byte `offset`,
+    in chunks of `chunksize` rows
+    '''
+    return iter_csv(file, offset, chunksize,
+                    na_values="None",
+                    dtype={'tweet_id': str,
+                           'relevant_url': str,
+                           'expanded': bool},
+                    parse_dates=['timestamp'])
+
+
+class TweetStatus(object):
+    '''
+    retweeted_status and quoted_status from a per-venue tweet file, with
+    the posted_on of the tweets.
+
+    get_relevant_urls.py writes its results in the order of the tweet file,
+    so both files are merged in that order and each is read only once.
+    `offset` is the start of the last tweet looked up, where the merge of
+    rows appended later picks up.
+    '''
+    columns = ['retweeted_status', 'quoted_status']
+
+    def __init__(self, file, offset=None):
+        self.f = open(str(file), "rb")
+        names = next(csv.reader([self.f.readline().decode("utf-8")]))
+        self.cols = [names.index(col) for col in ['tweet_id'] + self.columns + ['posted_on']]
+        if offset and offset <= os.fstat(self.f.fileno()).st_size:
+            self.f.seek(offset)
+        self._seek(self.f.tell())
+
+    def _seek(self, offset):
+        self.f.seek(offset)
+        self.offset = offset
+        self.lines = LineReader(self.f)
+        self.reader = csv.reader(self.lines)
+        self.current = None
+
+    def _next(self):
+        start = self.lines.offset
+        row = next(self.reader, None)
+        if row is None:
+            return False
+        self.offset = start
+        self.current = [row[i] or None for i in self.cols]
+        return True
+
+    def lookup(self, tweet_ids):
+        '''
+        DataFrame of the columns and posted_on for `tweet_ids`, which
+        follow the order of the tweet file. Tweets that are not found are
+        left empty: the scan for a tweet stops at the first tweet that
+        comes later in `tweet_ids`, or at the end of the file for all
+        remaining tweets.
+        '''
+        tweet_ids = list(tweet_ids)
+        last = {tweet_id: i for i, tweet_id in enumerate(tweet_ids)}
+        names = self.columns + ['posted_on']
+        values = [[None] * len(names) for _ in tweet_ids]
+        for i, tweet_id in enumerate(tweet_ids):
+            start = self.offset
+            while self.current is None or self.current[0] != tweet_id:
+                if self.current is not None and last.get(self.current[0], -1) > i:
+                    break
+                if not self._next():
+                    # none of the remaining tweets follow in the file
+                    self._seek(start)
+                    return pd.DataFrame(values, columns=names, dtype=object)
+            if self.current[0] == tweet_id:
+                values[i] = self.current[1:]
+        return pd.DataFrame(values, columns=names, dtype=object)
+
+    def close(self):
+        self.f.close()
+
+
 if __name__ == "__main__":
     root = Path('../../')
     Config = configparser.ConfigParser()
@@ -31,43 +106,82 @@ if __name__ == "__main__":
     tweet_dir = root / Config.get('output_files', 'tweets')
     twitter_urls = root / Config.get('output_files', 'twitter_urls')
 
-    input_files = Path("temp/")
+    temp_dir = Path("temp/")
+    window = time_window(Config)
 
     # Load files from disk
-    files = list(input_files.glob("*.csv"))
+    files = list(temp_dir.glob("*.csv"))
     queries = load_queries(str(queries))
-
-    dfs = []
-    for file in tqdm(files):
-        if "expanded_url" in str(file):
-            continue
-
-        filename = str(file).split("/")[-1]
-
-        # Load the original input tweet dataset
-        tweets = load_tweets(str(tweet_dir / filename))
-
-        # Load the temporary results
-        temp_df = pd.read_csv(file,
-                              na_values="None",
-                              dtype={'tweet_id': str,
-                                     'relevant_url': str,
-                                     'expanded': bool},
-                              parse_dates=['timestamp'])
-
-        # add retweeted and quoted tweet ids to df
-        temp_df = temp_df.merge(tweets[['retweeted_status', 'quoted_status']], left_index=True,
-                                right_index=True, how="left", validate="one_to_one")
-
-        v = filename.split(" ")[0]
-        terms = queries[queries.venue_short == v].relevant_terms.tolist()
-
-        temp_df['cleaned_url'] = temp_df.relevant_url.map(lambda x: clean_url(x, v))
-        temp_df['relevant'] = temp_df.cleaned_url.map(lambda x: relevant_url(x, v, terms))
-
-        dfs.append(temp_df)
-
-    urls = pd.concat(dfs)
-    urls.reset_index(drop=True)
-    urls.index.name = "id"
-    urls.to_csv(twitter_urls)
+    matcher = RelevanceMatcher(queries)
+    clean_cache = open_clean_cache(root, Config)
+
+    # Only rows appended to the temporary results since the last run are
+    # added to the final table, unless a result file was rewritten. The
+    # journal keeps {result file name: {offset, signature, tweet_offset}},
+    # the number of rows in the table and an ID of the table build, which
+    # only changes when the table is written from scratch.
+    table_format = Config.get('storage', 'format', fallback='parquet')
+    formats = [table_format]
+    if table_format != 'csv' and Config.getboolean('storage', 'export_csv', fallback=False):
+        formats.append('csv')
+    table = table_file(twitter_urls, table_format)
+    journal = table.with_name(table.name + ".checkpoint")
+    state = load_journal(journal)
+    marks = state.get('results', {})
+    append = bool(marks) and all(table_file(twitter_urls, fmt).exists() for fmt in formats) \
+        and not any(input_changed(temp_dir / name, mark) for name, mark in marks.items())
+    build = state.get('build')
+    if not append:
+        marks = {}
+        build = uuid.uuid4().hex
+
+    # The results are joined with their tweets and written chunk by chunk
+    writers = [TableWriter(twitter_urls, fmt, append=append) for fmt in formats]
+    try:
+        for file in tqdm(files):
+            if "expanded_url" in str(file) or "publisher_requests" in str(file):
+                continue
+
+            filename = str(file).split("/")[-1]
+            v = filename.split(" ")[0]
+
+            # Load the temporary results
+            mark = marks.get(filename, {})
+            offset = mark.get('offset')
+            size = file.stat().st_size
+            if offset == size:
+                continue
+
+            # the original input tweet dataset, for retweeted and quoted tweet ids
+            tweets = TweetStatus(tweet_dir / filename, mark.get('tweet_offset'))
+            for temp_df in read_results(file, offset):
+                status = tweets.lookup(temp_df.tweet_id)
+                # only URLs of tweets inside the [window]
+                keep = in_window(status['posted_on'], window)
+                temp_df, status = temp_df[keep], status[keep]
+                for col in TweetStatus.columns:
+                    temp_df[col] = status[col].values
+
+                temp_df['venue'] = v
+
+                temp_df['cleaned_url'] = clean_cache.clean_column(temp_df.relevant_url, v)
+                temp_df['relevant_term'] = matcher.match_column(temp_df.cleaned_url, v)
+                temp_df['relevant'] = temp_df.relevant_term.notna()
+
+                for writer in writers:
+                    writer.write(temp_df)
+            tweets.close()
+
+            marks[filename] = {'offset': size, 'signature': input_signature(file, size),
+                               'tweet_offset': tweets.offset}
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    print("Cleaned URLs: {}".format(clean_cache.report()))
+    clean_cache.close()
+
+    for writer in writers:
+        writer.close()
+    save_journal(journal, {'build': build, 'rows': writers[0].rows, 'results': marks})
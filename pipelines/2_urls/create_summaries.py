@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Summarize the tweets and Twitter URLs per venue.
+
+Only rows added since the last run are counted. The counters are kept next
+to the summaries (<summary>.checkpoint):
+    - per tweet file, the counts up to a byte offset and a signature of
+      the counted bytes; rewritten files are counted again
+    - for the Twitter URL table, the counters up to a row of a build of
+      the table (see create_final.py); a rebuilt table is counted again
+
+Only tweets inside the [window] are counted; the Twitter URL table only has
+URLs of those tweets (see create_final.py).
+
+Output:
+    - summary_tweets: found tweets by category and replies
+    - summary_refetch_errors: found tweets and tweets that failed to refetch
+    - summary_urls: found tweets, found and relevant URLs, distinct cleaned URLs
+'''
+
+import configparser
+from pathlib import Path
+
+from tqdm import tqdm
+
+import sys
+sys.path.append("../")
+
+from _helpers import *
+from _checkpoint import input_changed, input_signature, load_journal, save_journal
+from _summary import TweetSummary, URLSummary
+
+
+if __name__ == "__main__":
+    root = Path('../../')
+    Config = configparser.ConfigParser()
+    Config.read(str(root / 'config.cnf'))
+
+    tweet_dir = root / Config.get('output_files', 'tweets')
+    twitter_urls = root / Config.get('output_files', 'twitter_urls')
+    summary_tweets = root / Config.get('output_files', 'summary_tweets')
+    summary_urls = root / Config.get('output_files', 'summary_urls')
+    summary_errors = root / Config.get('output_files', 'summary_refetch_errors',
+                                       fallback='data/output/summary_refetch_errors.csv')
+    window = time_window(Config)
+
+    # Tweets, from the per-venue tweet files the tweets table is made of
+    tweet_journal = summary_tweets.with_name(summary_tweets.name + ".checkpoint")
+    marks = load_journal(tweet_journal)
+    tweet_summary = TweetSummary()
+    for file in tqdm(sorted(tweet_dir.glob("*.csv"))):
+        mark = marks.get(file.name)
+        if mark is not None and input_changed(file, mark):
+            mark = None
+        summary = TweetSummary.from_state(mark['counts'] if mark else None)
+
+        size = file.stat().st_size
+        offset = mark['offset'] if mark else None
+        if offset != size:
+            venue = file.name.split(" ")[0]
+            usecols = [col for col in TweetSummary.columns if col != 'venue'] + ['posted_on']
+            for chunk in iter_csv(file, offset, dtype=str, usecols=usecols):
+                chunk = chunk[in_window(chunk['posted_on'], window)]
+                summary.add(chunk.assign(venue=venue))
+
+        marks[file.name] = {'offset': size, 'signature': input_signature(file, size),
+                            'counts': summary.state()}
+        tweet_summary.merge(summary)
+    marks = {name: mark for name, mark in marks.items() if (tweet_dir / name).exists()}
+
+    tweet_counts = tweet_summary.table()
+    tweet_counts.to_csv(str(summary_tweets))
+    tweet_summary.errors().to_csv(str(summary_errors))
+    save_journal(tweet_journal, marks)
+    print(tweet_counts)
+
+    # Twitter URLs, from the rows appended to the table since the last run
+    table = table_file(twitter_urls, Config.get('storage', 'format', fallback='parquet'))
+    final = load_journal(table.with_name(table.name + ".checkpoint"))
+    url_journal = summary_urls.with_name(summary_urls.name + ".checkpoint")
+    url_summary, counted = URLSummary.load(url_journal)
+    start = counted.get('rows', 0)
+    if counted.get('build') is None or counted.get('build') != final.get('build') \
+            or start > final.get('rows', 0):
+        url_summary, start = URLSummary(), 0
+
+    rows = start
+    for chunk in tqdm(iter_table(table, columns=URLSummary.columns, start=start,
+                                 na_values="None", dtype={'cleaned_url': str}),
+                      unit="chunk"):
+        url_summary.add(chunk)
+        rows += len(chunk)
+
+    url_counts = url_summary.table(tweet_counts)
+    url_counts.to_csv(str(summary_urls))
+    url_summary.save(url_journal, build=final.get('build'), rows=rows)
+    print(url_counts)
@@ -4,6 +4,9 @@
 1. Iterate over tweets and match URLs with terms
 2. If none, expand URLs until URL matches with term
 
+The URLs of the tweets come from the long format tweet_urls table of
+1_tweets/refetch_tweets.py.
+
 Output file:
     - tweet_id
     - relevant_url
@@ -12,27 +15,22 @@ Output file:
 """
 
 import configparser
-import csv
-import json
 import logging
-import operator
-import os.path
 import sys
-from argparse import ArgumentParser
+from collections import OrderedDict, deque
 from datetime import datetime
 from pathlib import Path
-from urllib.parse import urlparse
 
+import numpy as np
 import pandas as pd
-import requests
-from dateutil.parser import parse
-from ratelimit import limits, sleep_and_retry
 from tqdm import tqdm
 
-import sys
 sys.path.append("../")
 
 from _helpers import *
+from _resolver import *
+from _url_cache import *
+from _checkpoint import Checkpoint
 
 tqdm.pandas()
 
@@ -60,32 +58,15 @@ class PublisherTracker(object):
         df.to_csv(file, index=True)
 
 
-@sleep_and_retry
-@limits(calls=1, period=1)
-def resolve_url(url, session, timeout=5):
-    try:
-        resp = session.get(url, allow_redirects=True, timeout=timeout)
-        return resp.url, None
-    except Exception as e:
-        return None, e
-
-
-def exp_write_row(f, row):
-    with open(str(f), 'a') as f:
-        exp_writer = csv.writer(f)
-        exp_writer.writerow(row)
-
-
 # file headers
 infile_headers = ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
                   'quoted_status', 'in_reply_to', 'urls', 'is_truncated',
                   'refetched', 'error']
 outfile_headers = ['tweet_id', 'relevant_url', 'expanded', 'timestamp']
-exp_url_headers = ['short_url', 'resolved_url', 'error', 'timestamp']
 
 # Local files
 output_dir = Path("temp/")
-exp_file = output_dir / "expanded_urls.csv"
+exp_file = output_dir / "expanded_urls.csv"  # legacy, imported into the URL cache
 pub_tracker_file = output_dir / "publisher_requests.csv"
 log_file = output_dir / "log.txt"
 
@@ -107,6 +88,46 @@ ch.setLevel(logging.INFO)
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+
+def tweet_url_candidates(urls):
+    '''
+    tweet_id -> tuple of the URLs to check for a tweet of the URL table
+    `urls`: url and expanded_url of every URL in tweet order, without
+    duplicates and links to twitter.com
+    '''
+    candidates = pd.DataFrame({
+        'tweet_id': np.repeat(urls.tweet_id.values, 2),
+        'order': np.repeat(2 * urls.url_index.values, 2) + np.tile([0, 1], len(urls)),
+        'url': np.column_stack([urls.url.values, urls.expanded_url.values]).ravel()})
+    candidates = candidates[candidates.url.notna()]
+    candidates = candidates.sort_values(['tweet_id', 'order'], kind='stable') \
+        .drop_duplicates(['tweet_id', 'url'])
+    candidates = candidates[~candidates.url.str.contains('twitter.com', regex=False)]
+    return candidates.groupby('tweet_id', sort=False).url.agg(tuple)
+
+
+def match_tweet_urls(url_candidates, venue_short, matcher, resolved):
+    '''
+    Look for a relevant URL without resolving anything. Returns the
+    relevant URL (or None), whether it was expanded and the candidates
+    that still need resolving.
+    '''
+    urls_to_remove = []
+    for url in url_candidates:
+        # Check if URL in tweet is relevant
+        if matcher.relevant(url, venue_short):
+            return url, False, []
+        # Check if previously resolved URL is relevant
+        if url in resolved:
+            r_url = resolved[url]
+            if matcher.relevant(r_url, venue_short):
+                return r_url, True, []
+            else:
+                urls_to_remove.append(url)
+
+    return None, False, [url for url in url_candidates if url not in urls_to_remove]
+
+
 if __name__ == "__main__":
     # Load config
     logger.info('# Loading configuration.')
@@ -117,34 +138,33 @@ if __name__ == "__main__":
     # Load files from disk
     queries = root / Config.get('input_files', 'queries')
     queries = load_queries(str(queries))
+    matcher = RelevanceMatcher(queries)
 
-    temp_tweets = root / "pipelines/2_urls/temp/"
+    # refetched tweets of 1_tweets/refetch_tweets.py
+    temp_tweets = root / Config.get('output_files', 'tweets')
     input_files = list(temp_tweets.glob("*.csv"))
+    tweet_urls = root / Config.get('output_files', 'tweet_urls')
 
     # Expanded URLs
-    logger.info("# Trying to load previously expanded URLs")
-    if exp_file.exists():
-        exp = pd.read_csv(str(exp_file), index_col=0)
-    else:
-        exp = pd.DataFrame(columns=exp_url_headers)
-        exp.to_csv(str(exp_file), index=True)
-
-    # # Clean and update exp_urls on disk
-    # exp = exp.drop_duplicates(subset=['short_url', 'resolved_url'])
-    # exp.reset_index(drop=True)
-    # exp.to_csv(str(exp_file), index=True)
-
-    expanded_url_count = len(exp)
-
-    # Create dicts and sets for looping
-    good_exp_urls = {}
-    for row in exp[exp.error.isnull()][['short_url', 'resolved_url']].itertuples():
-        good_exp_urls[row[1]] = row[2]  # if multiple urls, we just take the latest resolved one
-    bad_exp_urls = set(exp[exp.error.notnull()].short_url.tolist())
+    logger.info("# Opening URL cache")
+    cache = open_url_cache(root, Config)
+    if len(cache) == 0 and exp_file.exists():
+        logger.info("# Importing previously expanded URLs from {}".format(exp_file))
+        cache.import_csv(exp_file)
+    logger.info("# Found {} previously expanded URLs".format(len(cache)))
 
     # Init publication tracker
     pub_tracker = PublisherTracker()
 
+    # Concurrent resolver with a politeness budget per host
+    resolver = ConcurrentResolver(
+        workers=Config.getint('resolver', 'workers', fallback=8),
+        host_calls=Config.getint('resolver', 'host_calls', fallback=1),
+        host_period=Config.getfloat('resolver', 'host_period', fallback=1),
+        timeout=Config.getfloat('resolver', 'timeout', fallback=5),
+        known=cache.resolved)
+    batch_size = Config.getint('resolver', 'batch_size', fallback=1000)
+
     for infile in input_files:
         logger.info("## Processing {} ".format(infile.name))
         # Skip files that start with _ (IFLscience, Chicago-Suntimes)
@@ -152,133 +172,120 @@ if __name__ == "__main__":
             logger.info("## Skipping {}")
             continue
 
-        # Final output file
+        # Final output file, resumed from its last checkpoint
         outfile = output_dir / infile.name
-        if outfile.exists():
-            logger.info("## URLs already exist. Appending new rows.")
-            previous_tweets = pd.read_csv(str(outfile), dtype={'tweet_id': str})
-        else:
-            logger.info("## URLs do not exist. Creating new file..")
-            previous_tweets = pd.DataFrame(columns=outfile_headers)
-            previous_tweets.to_csv(str(outfile), index=False)
-
-        previous_tweet_ids = set(previous_tweets.tweet_id.tolist())
-        logger.info("## Found {} relevant URLs".format(len(previous_tweet_ids)))
+        checkpoint = Checkpoint(infile, outfile, outfile_headers)
+        if checkpoint.done:
+            logger.info("## URLs are up to date. Skipping.")
+            continue
+        if checkpoint.rows:
+            logger.info("## Resuming after {} tweets".format(checkpoint.rows))
 
         # Open file stream
         logger.info("## Creating file streams")
-        infile = open(str(infile), "r")
-        reader = csv.reader(infile)
-        count = sum(1 for _ in reader) - 1  # count number of rows minus header
-        infile.seek(0)
-        reader = csv.reader(infile)
-        next(reader, None)
-
-        outfile = open(str(outfile), "a")
-        writer = csv.writer(outfile)
+        reader, writer = checkpoint.open()
 
         # Load relevant terms
         query = infile.name.split("/")[-1].split(".")[0]
         venue_short = query.split(" ")[0]
 
-        terms = queries.groupby("venue_short")['relevant_terms'].apply(lambda x: list(x))
-        terms = terms[venue_short]
-
-        session = requests.Session()
-
-        for row in tqdm(reader, total=count):
-            tweet_id = row[0]
-
-            if tweet_id in previous_tweet_ids:
-                logger.debug("### {}: Tweet already has relevant URL.".format(tweet_id))
-                continue
-
-            tweet = load_json(row[2])
-            if not tweet:
-                logging.debug("### {}: Couldn't load tweet".format(tweet_id))
-                continue
+        # tweet_id -> URLs to check, for the tweets of the venue with URLs
+        candidates = tweet_url_candidates(load_url_table(tweet_urls, venue_short))
+
+        # Retweets carry the URLs of their original tweet, so relevance is
+        # checked and URLs are resolved once per distinct list of URLs.
+        # urls -> (found_url, expanded) or None, for all tweets of the file
+        originals = {}
+        n_tweets = 0
+
+        # progress in bytes of the input, so resuming doesn't rescan it
+        position = checkpoint.lines.offset
+        progress = tqdm(total=infile.stat().st_size, initial=position,
+                        unit="B", unit_scale=True)
+        for batch in iter_batches(reader, batch_size):
+            progress.update(checkpoint.lines.offset - position)
+            position = checkpoint.lines.offset
+
+            # tweets with URLs, in file order
+            batch = pd.DataFrame({'tweet_id': [row[0] for row in batch]})
+            batch['urls'] = batch.tweet_id.map(candidates)
+            batch = batch[batch.urls.notna()]
+            n_tweets += len(batch)
+
+            # (urls, candidates) of URL lists that were not seen before
+            rows = []
+            # urls -> (found_url, expanded) in file order
+            found = OrderedDict()
+            # urls -> candidates that still have to be resolved
+            pending = OrderedDict()
+
+            for key in batch.urls.unique():
+                if key not in originals:
+                    rows.append((key, list(key)))
+            logger.debug("### {} tweets, {} new URL lists.".format(len(batch), len(rows)))
+
+            # Look up all URLs of the batch in the cache at once
+            resolved = cache.lookup(url for _, urls in rows for url in urls)
+
+            for key, url_candidates in rows:
+                found_url, expanded, url_candidates = match_tweet_urls(
+                    url_candidates, venue_short, matcher, resolved)
+                found[key] = None
+                if found_url:
+                    found[key] = (found_url, expanded)
+                elif url_candidates:
+                    pending[key] = deque(url_candidates)
+
+            # Resolve the next candidate of every pending URL list, one round at a time
+            while pending:
+                next_urls = OrderedDict((key, urls.popleft())
+                                        for key, urls in pending.items())
+
+                new_urls = cache.due(url for url in next_urls.values() if url not in resolved)
+                logger.debug("### Resolving {} URLs.".format(len(new_urls)))
+                for url, r_url, error, chain in resolver.resolve_all(new_urls):
+                    cache.put(url, r_url, error)
+                    if r_url:
+                        resolved[url] = r_url
+                        # intermediate hops resolve to the same URL
+                        for hop in chain[1:-1]:
+                            cache.put(hop, r_url)
+                cache.flush()
+
+                for key, url in next_urls.items():
+                    r_url = resolved.get(url)
+                    if r_url and matcher.relevant(r_url, venue_short):
+                        found[key] = (r_url, True)
+                        del pending[key]
+                    elif not pending[key]:
+                        del pending[key]
+            originals.update(found)
+
+            # Fan the results out to every tweet with the same URLs
+            batch = batch.assign(result=batch.urls.map(originals))
+            batch = batch[batch.result.notna()]
 
             try:
-                # Get tweet & retweet URLs
-                s = row[infile_headers.index('urls')]
-                if pd.isna(s) or s is "":
-                    logger.debug("### {}: Tweet contains no URLs.".format(tweet_id))
-                    continue
-                url_candidates = json.loads(s)
-
-                # remove links to twitter urls
-                url_candidates = [url for url in url_candidates if 'twitter.com' not in url]
-
-                found_url = None
-                expanded = False
-                # Match with the selected news venue
-                urls_to_remove = []
-                for url in url_candidates:
-                    # Check if URL in tweet is relevant
-                    if relevant_url(url, venue_short, terms):
-                        logger.debug("### {}: Found relevant link in tweet.".format(tweet_id))
-                        found_url = url
-                        break
-                    # Check if previously resolved URL is relevant
-                    if url in good_exp_urls:
-                        r_url = good_exp_urls[url]
-                        if relevant_url(r_url, venue_short, terms):
-                            logger.debug("### {}: Reusing previous resolve.".format(tweet_id))
-                            found_url = r_url
-                            expanded = True
-                            break
-                        else:
-                            urls_to_remove.append(url)
-
-                url_candidates = [url for url in url_candidates if url not in urls_to_remove]
-
-                if not found_url:
-                    for url in url_candidates:
-                        r_url, error = None, None
-                        # Find candidate URL in existing data or with resolving
-                        if url in bad_exp_urls:
-                            logger.debug(
-                                "### {}: Resolving URL that previously failed.".format(tweet_id))
-                            r_url, error = resolve_url(url, session)
-                            expanded = True
-
-                            if r_url:
-                                good_exp_urls[url] = r_url
-                                bad_exp_urls.remove(url)
-
-                                row = [expanded_url_count, url, r_url, error, str(datetime.now())]
-                                exp_write_row(str(exp_file), row)
-                                expanded_url_count = expanded_url_count + 1
-                        else:
-                            logger.debug("### {}: New URL. Resolving.".format(tweet_id))
-                            r_url, error = resolve_url(url, session)
-                            expanded = True
-
-                            row = [expanded_url_count, url, r_url, error, str(datetime.now())]
-                            exp_write_row(str(exp_file), row)
-                            expanded_url_count = expanded_url_count + 1
-
-                            if r_url:
-                                good_exp_urls[url] = r_url
-                            else:
-                                bad_exp_urls.add(url)
-
-                        if r_url:
-                            if relevant_url(r_url, venue_short, terms):
-                                found_url = r_url
-                                break
-
-                if found_url:
+                for tweet_id, (found_url, expanded) in zip(batch.tweet_id, batch.result):
+                    logger.debug("### {}: Found relevant link.".format(tweet_id))
                     pub_tracker.check_url(found_url)
 
                     now = str(datetime.now())
                     writer.writerow([str(tweet_id), str(found_url), expanded, now])
-                    outfile.flush()
+                checkpoint.commit()
             except TooManyPublisherRequests:
                 logger.exception("Too many requests to publishers")
                 pub_tracker.save_csv(pub_tracker_file)
+                checkpoint.close()
+                resolver.close()
+                cache.close()
                 sys.exit(0)
+        progress.close()
+        logger.info("## {} tweets with URLs, {} distinct URL lists".format(
+            n_tweets, len(originals)))
+
         # Close file streams
-        infile.close()
-        outfile.close()
+        checkpoint.finish()
+    resolver.close()
+    cache.close()
     pub_tracker.save_csv(pub_tracker_file)
@@ -3,6 +3,7 @@
 
 import configparser
 from pathlib import Path
+from urllib.parse import urlparse
 
 import pandas as pd
 
@@ -18,6 +19,32 @@ def assign_venue(x, venues):
             return venue
     return None
 
+
+def url_domain(url):
+    '''
+    Lower-case host name of a venue URL
+    '''
+    return urlparse(url if "//" in url else "//" + url).hostname or ""
+
+
+def domain_index(domains, venues):
+    '''
+    domain -> venue_short for every distinct domain. A domain belongs to the
+    first venue that is one of its labels (www.nytimes.com -> nytimes),
+    found in a label -> venue dict; other domains fall back to the
+    substring match of assign_venue.
+    '''
+    order = {}
+    for i, venue in enumerate(venues):
+        order.setdefault(venue, i)
+
+    index = {}
+    for domain in domains:
+        hits = [order[label] for label in domain.split(".") if label in order]
+        index[domain] = venues[min(hits)] if hits else assign_venue(domain, venues)
+    return index
+
+
 if __name__ == "__main__":
     root = Path('../../')
     Config = configparser.ConfigParser()
@@ -29,9 +56,10 @@ if __name__ == "__main__":
     queries = root / Config.get('input_files', 'queries')
     queries = load_queries(str(queries))
 
-    # Load Altmetric Excel sheet and save cleaned version
-    am_news_mentions = pd.read_excel(raw_altmetric, sheet_name=1,
-                                     index_col="Altmetric_ID", parse_dates=['Posted_On'])
+    # Load Altmetric Excel sheet (from its snapshot if unchanged) and save cleaned version
+    snapshot_dir = root / Config.get('storage', 'snapshot_dir', fallback='data/snapshots/')
+    am_news_mentions = read_excel_snapshot(raw_altmetric, 1, snapshot_dir,
+                                           index_col="Altmetric_ID", parse_dates=['Posted_On'])
     am_news_mentions.index.name = 'altmetric_id'
     am_news_mentions.rename(columns={'Author_name': 'venue_name',
                                      'Url': 'altmetric_url',
@@ -40,6 +68,7 @@ if __name__ == "__main__":
 
     # Assign short labels for venues
     short_venues = queries['venue_short'].unique().tolist()
-    am_news_mentions['venue_short'] = am_news_mentions['venue_url'].map(
-        lambda x: assign_venue(x, short_venues))
+    domains = am_news_mentions['venue_url'].map(url_domain, na_action='ignore')
+    venues = domain_index(domains.dropna().unique(), short_venues)
+    am_news_mentions['venue_short'] = domains.map(venues)
     am_news_mentions.to_csv(altmetric)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Join the relevant Twitter URLs with the Altmetric news mentions.
+
+Output:
+    - summary_altmetric: distinct relevant URLs per venue found on
+      Twitter, by Altmetric and by both
+    - news_urls_sample: the [join] sample_size relevant URLs found by
+      Twitter and Altmetric with the most tweets: relevant_url,
+      tweet_count, altmetric_ids (comma separated)
+'''
+
+import configparser
+from pathlib import Path
+
+import pandas as pd
+from tqdm import tqdm
+
+import sys
+sys.path.append("../")
+
+from _helpers import *
+from _join import URLJoin
+
+
+def top_urls(urls, n):
+    '''
+    The `n` URLs with the most tweets, ties by URL
+    '''
+    return urls.sort_values(by=['tweet_count', 'relevant_url'],
+                            ascending=[False, True]).head(n)
+
+
+if __name__ == "__main__":
+    root = Path('../../')
+    Config = configparser.ConfigParser()
+    Config.read(str(root / 'config.cnf'))
+
+    twitter_urls = root / Config.get('output_files', 'twitter_urls')
+    altmetric_urls = root / Config.get('output_files', 'altmetric_urls')
+    summary_altmetric = root / Config.get('output_files', 'summary_altmetric')
+    news_urls_sample = root / Config.get('output_files', 'news_urls_sample')
+
+    partitions = Config.getint('join', 'partitions', fallback=1)
+    chunksize = Config.getint('join', 'chunk_rows', fallback=100000)
+    sample_size = Config.getint('join', 'sample_size', fallback=50)
+
+    altmetric = load_altmetric(altmetric_urls,
+                               columns=['altmetric_id', 'venue_short', 'clean_url', 'relevant'])
+
+    with URLJoin(altmetric, partitions=partitions,
+                 spill_dir=str(root / Config.get('join', 'spill_dir', fallback='data/'))) as join:
+        # Stream the Twitter side
+        for chunk in tqdm(iter_table(twitter_urls, columns=['venue', 'cleaned_url', 'relevant'],
+                                     chunksize=chunksize, na_values="None",
+                                     dtype={'cleaned_url': str}),
+                          unit="chunk"):
+            join.add_tweets(chunk)
+
+        # Keep the top URLs of every partition, then the overall top URLs
+        columns = ['relevant_url', 'tweet_count', 'altmetric_ids']
+        samples = [pd.DataFrame(columns=columns)]
+        for urls in join.iter_urls():
+            urls = urls[urls['altmetric_ids'].notna()]
+            samples.append(top_urls(urls[columns], sample_size))
+        sample = top_urls(pd.concat(samples, ignore_index=True), sample_size)
+        sample.to_csv(str(news_urls_sample), index=False)
+
+        overlap = join.overlap()
+        overlap.to_csv(str(summary_altmetric))
+    print(overlap)
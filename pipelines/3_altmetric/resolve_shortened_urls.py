@@ -4,14 +4,16 @@
 import configparser
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-import requests
 from tqdm import tqdm
 
 import sys
 sys.path.append("../")
 
 from _helpers import *
+from _resolver import *
+from _url_cache import *
 
 tqdm.pandas()
 
@@ -26,34 +28,54 @@ if __name__ == "__main__":
 
     queries = root / Config.get('input_files', 'queries')
     queries = load_queries(str(queries))
+    matcher = RelevanceMatcher(queries)
 
     am_news_mentions = pd.read_csv(altmetric_mentions)
 
-    am_news_mentions = am_news_mentions.assign(resolve_url=np.nan, resolve_error=np.nan)
-    am_news_mentions = am_news_mentions.assign(url=np.nan, clean_url=np.nan)
-
-    # Resolve missing URLs
-    session = requests.Session()
-    for index, row in tqdm(am_news_mentions.iterrows(), total=len(am_news_mentions)):
-        v = row['venue_short']
-        terms = queries[queries.venue_short == v].relevant_terms.tolist()
-
-        if 'moreover' in row['altmetric_url']:
-            url, error = None, None
-
-            try:
-                resp = session.head(row['altmetric_url'], allow_redirects=True, timeout=10)
-                url, error = resp.url, None
-            except Exception as e:
-                url, error = None, e
-
-            am_news_mentions.loc[index, 'url'] = url
-            am_news_mentions.loc[index, 'resolve_error'] = error
-        else:
-            am_news_mentions.loc[index, 'url'] = row['altmetric_url']
-
-        am_news_mentions.loc[index, 'clean_url'] = clean_url(row['url'], row['venue_short'])
-        am_news_mentions.loc[index, 'relevant'] = relevant_url(
-            row['clean_url'], row['venue_short'], terms)
-
-    am_news_mentions.to_csv(altmetric_urls)
+    # moreover.com links redirect to the article, all others are the article URL
+    moreover = am_news_mentions['altmetric_url'].str.contains('moreover', regex=False, na=False)
+    short_urls = am_news_mentions.loc[moreover, 'altmetric_url'].unique()
+
+    # Resolve each unique moreover URL once, concurrently
+    cache = open_url_cache(root, Config)
+    new_urls = cache.due(short_urls)
+    print("Resolving {} of {} unique moreover URLs".format(len(new_urls), len(short_urls)))
+
+    resolver = ConcurrentResolver(
+        workers=Config.getint('resolver', 'workers', fallback=8),
+        host_calls=Config.getint('resolver', 'host_calls', fallback=1),
+        host_period=Config.getfloat('resolver', 'host_period', fallback=1),
+        timeout=10,
+        known=cache.resolved)
+    with resolver:
+        for url, r_url, error, chain in tqdm(resolver.resolve_all(new_urls), total=len(new_urls)):
+            cache.put(url, r_url, error)
+            if r_url:
+                # intermediate hops resolve to the same URL
+                for hop in chain[1:-1]:
+                    cache.put(hop, r_url)
+    cache.flush()
+
+    results = pd.DataFrame([cache.get(url) or (None, None) for url in short_urls],
+                           index=short_urls, columns=['url', 'error'], dtype=object)
+    cache.close()
+
+    # Broadcast the results to every mention
+    resolved = am_news_mentions['altmetric_url'].where(moreover)
+    am_news_mentions['url'] = am_news_mentions['altmetric_url'].where(
+        ~moreover, resolved.map(results['url']))
+    am_news_mentions['resolve_error'] = resolved.map(results['error'])
+
+    # Normalize each unique (url, venue) pair once
+    with open_clean_cache(root, Config) as clean_cache:
+        am_news_mentions['clean_url'] = clean_cache.clean_column(
+            am_news_mentions['url'], am_news_mentions['venue_short'])
+        print("Cleaned URLs: {}".format(clean_cache.report()))
+    am_news_mentions['relevant'] = matcher.relevant_column(
+        am_news_mentions['clean_url'], am_news_mentions['venue_short'])
+
+    am_news_mentions.index.name = "id"
+    table_format = Config.get('storage', 'format', fallback='parquet')
+    save_table(am_news_mentions, altmetric_urls, table_format)
+    if table_format != 'csv' and Config.getboolean('storage', 'export_csv', fallback=False):
+        save_table(am_news_mentions, altmetric_urls, 'csv')
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Crash-safe, incremental checkpoints for stages that turn one input file into
+one output CSV.
+
+A journal next to the output file (<outfile>.checkpoint) records the input
+offset and the output length of the last commit. The output is fsynced before
+the journal is replaced, so after a crash the output is cut back to the
+committed length and reading resumes at the committed input offset: no row
+is processed, requested or written twice.
+
+Inputs are treated as append-only. A finished checkpoint is reopened when its
+input has grown since, and only the appended records are processed. The
+journal keeps a signature of the consumed part of the input (its first and
+last bytes); if that changed, the input was rewritten and the output is
+built again from scratch. The journal also keeps high-water marks, e.g. the
+largest tweet_id and posted_on seen so far, and a zone map: the min/max
+values of each committed chunk of the output, so readers can skip chunks
+outside the values they need without parsing them.
+'''
+
+import csv
+import hashlib
+import json
+import os
+from collections import deque
+from pathlib import Path
+
+# bytes at the start and before the end of the consumed input in the signature
+_head_size = 2**16
+_tail_size = 2**12
+
+
+def input_signature(file, size):
+    '''
+    Hash over the first and last bytes of the first `size` bytes of a file
+    '''
+    sha = hashlib.sha256()
+    with open(str(file), "rb") as f:
+        sha.update(f.read(min(size, _head_size)))
+        f.seek(max(0, size - _tail_size))
+        sha.update(f.read(min(size, _tail_size)))
+    return sha.hexdigest()
+
+
+def input_changed(file, mark):
+    '''
+    Whether the first mark['offset'] bytes of a file, with the signature
+    mark['signature'], were removed or rewritten since
+    '''
+    file = Path(str(file))
+    if not file.exists() or file.stat().st_size < mark['offset']:
+        return True
+    return input_signature(file, mark['offset']) != mark['signature']
+
+
+def load_journal(file):
+    '''
+    JSON journal of a stage that keeps its own state, {} if there is none
+    '''
+    try:
+        with open(str(file), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_journal(file, state):
+    '''
+    Atomically replace a JSON journal
+    '''
+    file = Path(str(file))
+    tmp = file.with_name(file.name + ".tmp")
+    with open(str(tmp), "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(str(tmp), str(file))
+
+
+def load_zones(file):
+    '''
+    Zone map of an output written with a checkpoint:
+    [{'start': offset, 'end': offset, column: [min, max], ...}]
+    '''
+    journal = Path(str(file))
+    try:
+        with open(str(journal.with_name(journal.name + ".checkpoint")), "r") as f:
+            return json.load(f).get('zones', [])
+    except (OSError, ValueError):
+        return []
+
+
+def skip_ranges(zones, column, low, high):
+    '''
+    Byte ranges of the zones whose `column` values all lie outside [low, high)
+    '''
+    return [(zone['start'], zone['end']) for zone in zones
+            if column in zone and (zone[column][1] < low or zone[column][0] >= high)]
+
+
+class LineReader(object):
+    '''
+    Decoded lines of a binary file that keep track of the byte offset
+    behind the last line handed out. Lines inside the sorted byte ranges
+    `skip` are jumped over without being read.
+    '''
+    def __init__(self, f, rows=0, encoding="utf-8", skip=()):
+        self.f = f
+        self.encoding = encoding
+        self.offset = f.tell()
+        self.rows = rows
+        self.skip = deque(sorted(skip))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.skip and self.offset >= self.skip[0][0]:
+            start, end = self.skip.popleft()
+            if self.offset < end:
+                self.f.seek(end)
+                self.offset = end
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        self.rows += 1
+        return line.decode(self.encoding)
+
+
+class Checkpoint(object):
+    '''
+    Resumable processing of `infile` into `outfile`.
+
+    `open()` returns a csv reader and writer positioned at the last commit.
+    Call `commit()` whenever all rows read so far have been written, and
+    `finish()` at the end of the input. Stages that read their input
+    themselves use `open_output()`, `input_offset` and
+    `commit(input_offset, rows)` instead.
+
+    Outputs without a journal were written before checkpoints existed; they
+    are left untouched and reported as done.
+    '''
+    def __init__(self, infile, outfile, headers, skip_header=True):
+        self.infile = Path(str(infile))
+        self.outfile = Path(str(outfile))
+        self.journal = self.outfile.with_name(self.outfile.name + ".checkpoint")
+        self.headers = headers
+        self.skip_header = skip_header
+        self.state = self._load()
+        self.inf = None
+        self.outf = None
+        self.lines = None
+        self.pending_zone = None
+
+    def _load(self):
+        try:
+            with open(str(self.journal), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _input_changed(self):
+        '''
+        Whether the consumed part of the input is no longer the same
+        '''
+        if 'input_size' not in self.state:
+            return False
+        size = self.state['input_size']
+        if self.infile.stat().st_size < size:
+            return True
+        return self.state.get('signature') != input_signature(self.infile, size)
+
+    @property
+    def done(self):
+        '''
+        Whether the whole input has been processed. False if records were
+        appended to the input since.
+        '''
+        if self.state is None:
+            return self.outfile.exists()
+        return self.state['done'] and \
+            self.infile.stat().st_size == self.state.get('input_size')
+
+    @property
+    def rows(self):
+        '''
+        Number of input lines committed so far (one per row, unless
+        fields contain line breaks)
+        '''
+        return self.state['rows'] if self.state else 0
+
+    @property
+    def input_offset(self):
+        '''
+        Input offset of the last commit, None if nothing was committed
+        '''
+        return self.state.get('input_offset') if self.state else None
+
+    @property
+    def marks(self):
+        '''
+        High-water marks recorded so far
+        '''
+        return dict(self.state.get('marks', {})) if self.state else {}
+
+    def mark(self, **values):
+        '''
+        Raise the high-water marks to `values`, committed with the next commit
+        '''
+        marks = self.state.setdefault('marks', {})
+        for key, value in values.items():
+            if value is not None and (marks.get(key) is None or value > marks[key]):
+                marks[key] = value
+
+    @property
+    def zones(self):
+        '''
+        Zone map of the committed output
+        '''
+        return list(self.state.get('zones', [])) if self.state else []
+
+    def zone(self, **ranges):
+        '''
+        Record the (min, max) of columns over the rows written since the
+        last commit, committed with the next commit
+        '''
+        self.pending_zone = {key: [low, high] for key, (low, high) in ranges.items()}
+
+    def open_output(self):
+        '''
+        Open the output for appending, cut back to its committed length.
+        A new or rewritten input starts a new output with a header row.
+        '''
+        if self.state is not None and self._input_changed():
+            print("{} changed. Processing it again".format(self.infile))
+            self.state = None
+
+        if self.state is None:
+            self.state = {'rows': 0, 'done': False, 'marks': {}}
+            self.outf = open(str(self.outfile), "w")
+            csv.writer(self.outf).writerow(self.headers)
+            self._sync()
+            self.state['output_offset'] = self.outf.tell()
+            self._save()
+        else:
+            self.state['done'] = False
+            os.truncate(str(self.outfile), self.state['output_offset'])
+            self.outf = open(str(self.outfile), "a")
+        return self.outf
+
+    def open(self, skip=()):
+        '''
+        Open the input at the committed offset and the output cut back to
+        its committed length. Returns (csv reader, csv writer); the reader
+        jumps over the input byte ranges in `skip`.
+        '''
+        self.open_output()
+        self.inf = open(str(self.infile), "rb")
+        if self.input_offset is None:
+            if self.skip_header:
+                self.inf.readline()
+        else:
+            self.inf.seek(self.input_offset)
+
+        self.lines = LineReader(self.inf, self.state['rows'], skip=skip)
+        return csv.reader(self.lines), csv.writer(self.outf)
+
+    def commit(self, input_offset=None, rows=None, input_size=None):
+        '''
+        Make everything written so far durable and record how far the
+        input has been consumed. `input_size` is the number of input bytes
+        covered by the signature, `input_offset` by default.
+        '''
+        if input_offset is None:
+            input_offset, rows = self.lines.offset, self.lines.rows
+        if input_size is None:
+            input_size = input_offset
+
+        self._sync()
+
+        if input_size != self.state.get('input_size'):
+            self.state['signature'] = input_signature(self.infile, input_size)
+        if self.pending_zone is not None:
+            self.pending_zone.update(start=self.state['output_offset'], end=self.outf.tell())
+            self.state.setdefault('zones', []).append(self.pending_zone)
+            self.pending_zone = None
+        self.state.update(input_offset=input_offset,
+                          input_size=input_size,
+                          output_offset=self.outf.tell(),
+                          rows=rows)
+        self._save()
+
+    def _sync(self):
+        self.outf.flush()
+        os.fsync(self.outf.fileno())
+
+    def _save(self):
+        tmp = self.journal.with_name(self.journal.name + ".tmp")
+        with open(str(tmp), "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(tmp), str(self.journal))
+
+    def finish(self, *args, **kwargs):
+        '''
+        Commit and mark the input as fully processed
+        '''
+        self.state['done'] = True
+        self.commit(*args, **kwargs)
+        self.close()
+
+    def close(self):
+        for f in (self.inf, self.outf):
+            if f is not None:
+                f.close()
+        self.inf = self.outf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
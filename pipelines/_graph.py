@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Retweet/quote/reply graph of the collected tweets.
+
+Tweet IDs and edges (tweet -> retweeted, quoted or replied-to tweet) are
+kept as sorted int64 arrays, 8 bytes per ID, and all queries are vectorized
+searchsorted lookups, so millions of edges fit in memory and are queried in
+seconds. Cascades follow the edges from every tweet up to its original
+(the first tweet outside of any retweet/quote chain) by pointer jumping.
+'''
+
+import numpy as np
+import pandas as pd
+
+from _helpers import ids_to_int, iter_table
+
+# edge kind -> column with the referenced tweet
+EDGE_COLUMNS = {'retweet': 'retweeted_status',
+                'quote': 'quoted_status',
+                'reply': 'in_reply_to'}
+
+
+def _int_ids(values):
+    '''
+    int64 IDs and the mask of non-null values of an ID column
+    '''
+    values = ids_to_int(values)
+    mask = values.notna().values
+    return values.fillna(0).astype(np.int64).values, mask
+
+
+def sorted_unique(*arrays):
+    '''
+    Sorted unique values of int64 arrays (sort based, fast for IDs)
+    '''
+    ids = np.sort(np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64))
+    new = np.ones(len(ids), dtype=bool)
+    new[1:] = ids[1:] != ids[:-1]
+    return ids[new]
+
+
+def contains(sorted_ids, ids):
+    '''
+    Boolean mask of the `ids` found in the sorted array `sorted_ids`
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return sorted_ids[pos] == ids
+
+
+class TweetGraph(object):
+    '''
+    `tweet_ids`: sorted unique IDs of the collected tweets,
+    `edges`: {kind: (source IDs, target IDs)}, sorted by source
+    '''
+    def __init__(self, tweet_ids, edges):
+        self.tweet_ids = tweet_ids
+        self.edges = edges
+        self._cascades = {}
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        '''
+        Build the graph from chunks of the tweets table; only the IDs of
+        every chunk are kept
+        '''
+        ids = []
+        edges = {kind: [] for kind in EDGE_COLUMNS}
+        for chunk in chunks:
+            tweet_ids, mask = _int_ids(chunk['tweet_id'])
+            ids.append(sorted_unique(tweet_ids[mask]))
+            for kind, col in EDGE_COLUMNS.items():
+                targets, has = _int_ids(chunk[col])
+                has = has & mask
+                edges[kind].append((tweet_ids[has], targets[has]))
+
+        tweet_ids = sorted_unique(*ids)
+        for kind, pairs in edges.items():
+            sources = np.concatenate([p[0] for p in pairs]) if pairs else np.zeros(0, dtype=np.int64)
+            targets = np.concatenate([p[1] for p in pairs]) if pairs else np.zeros(0, dtype=np.int64)
+            order = np.lexsort((targets, sources))
+            sources, targets = sources[order], targets[order]
+            new = np.ones(len(sources), dtype=bool)
+            new[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+            edges[kind] = (sources[new], targets[new])
+        return cls(tweet_ids, edges)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls.from_chunks([df])
+
+    @classmethod
+    def from_table(cls, file):
+        '''
+        Build the graph in one streaming pass over a stored tweets table
+        '''
+        columns = ['tweet_id'] + list(EDGE_COLUMNS.values())
+        return cls.from_chunks(iter_table(file, columns=columns, index_col=None,
+                                          dtype={col: str for col in columns}))
+
+    def contains(self, ids):
+        '''
+        Boolean mask of the `ids` that are in the collection
+        '''
+        return contains(self.tweet_ids, ids)
+
+    def coverage(self, kind):
+        '''
+        (tweets with an edge of `kind`, distinct referenced tweets,
+        referenced tweets in the collection)
+        '''
+        sources, targets = self.edges[kind]
+        targets = sorted_unique(targets)
+        return len(sorted_unique(sources)), len(targets), int(self.contains(targets).sum())
+
+    def _resolve(self, kinds):
+        '''
+        All tweets (collected and referenced) with their root and depth
+        along the edges of `kinds`; earlier kinds take precedence when a
+        tweet has several edges
+        '''
+        kinds = tuple(kinds)
+        if kinds in self._cascades:
+            return self._cascades[kinds]
+
+        nodes = sorted_unique(self.tweet_ids, *[self.edges[kind][1] for kind in kinds])
+
+        parent = np.full(len(nodes), -1, dtype=np.int64)
+        for kind in reversed(kinds):
+            sources, targets = self.edges[kind]
+            parent[np.searchsorted(nodes, sources)] = np.searchsorted(nodes, targets)
+        parent[parent == np.arange(len(nodes))] = -1
+
+        # pointer jumping: after k rounds every tweet points 2**k steps up
+        up = parent.copy()
+        depth = (parent >= 0).astype(np.int64)
+        for _ in range(64):
+            has = np.flatnonzero(up >= 0)
+            jump = has[up[up[has]] >= 0]
+            if len(jump) == 0:
+                break
+            depth[jump] += depth[up[jump]]
+            up[jump] = up[up[jump]]
+
+        root = np.where(up >= 0, up, np.arange(len(nodes)))
+        self._cascades[kinds] = (nodes, root, depth)
+        return self._cascades[kinds]
+
+    def roots(self, ids, kinds=('retweet', 'quote')):
+        '''
+        Root tweet and depth of every tweet in `ids`; tweets outside of
+        the graph are their own root
+        '''
+        nodes, root, depth = self._resolve(kinds)
+        ids = np.asarray(ids, dtype=np.int64)
+        found = contains(nodes, ids)
+        pos = np.searchsorted(nodes, ids[found])
+        roots, depths = ids.copy(), np.zeros(len(ids), dtype=np.int64)
+        roots[found] = nodes[root[pos]]
+        depths[found] = depth[pos]
+        return roots, depths
+
+    def cascades(self, kinds=('retweet', 'quote')):
+        '''
+        Cascade per original tweet: number of tweets below it, their
+        maximum depth and whether the original is in the collection
+        '''
+        nodes, root, depth = self._resolve(kinds)
+        below = root != np.arange(len(nodes))
+        df = pd.DataFrame({'root': root[below], 'depth': depth[below]})
+        df = df.groupby('root').agg(size=('depth', 'size'), depth=('depth', 'max'))
+        df.index = pd.Index(nodes[df.index.values], name="tweet_id")
+        df['found'] = self.contains(df.index.values)
+        return df
+
+    def url_cascades(self, tweet_ids, urls, kinds=('retweet', 'quote')):
+        '''
+        Cascades per URL: tweets with the URL, distinct originals they
+        go back to and the maximum depth among them
+        '''
+        ids, mask = _int_ids(tweet_ids)
+        urls = np.asarray(urls, dtype=object)
+        mask = mask & pd.notna(urls)
+        roots, depths = self.roots(ids[mask], kinds)
+        df = pd.DataFrame({'url': urls[mask], 'root': roots, 'depth': depths})
+        df = df.groupby('url').agg(tweets=('root', 'size'), originals=('root', 'nunique'),
+                                   depth=('depth', 'max'))
+        return df.sort_values(by="tweets", ascending=False)
@@ -1,11 +1,120 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import ast
+import bz2
+import csv
+import gzip
+import hashlib
 import json
+import lzma
+import operator
+import os
+import re
+import shutil
+from itertools import compress, islice
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import urltools
+from dateutil.parser import parse
+
+
+# Raw tweet dumps
+RAW_FORMATS = {'.csv': 'csv', '.txt': 'tsv', '.tsv': 'tsv', '.jsonl': 'jsonl'}
+RAW_COMPRESSIONS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def raw_format(file):
+    '''
+    Detect format and compression of a raw tweet dump from its suffixes,
+    e.g. "foxnews AND science.txt.gz" -> ('tsv', '.gz').
+    Returns (None, None) for files that are not raw dumps.
+    '''
+    suffixes = Path(str(file)).suffixes
+    compression = None
+    if suffixes and suffixes[-1] in RAW_COMPRESSIONS:
+        compression = suffixes.pop()
+    if not suffixes or suffixes[-1] not in RAW_FORMATS:
+        return None, None
+    return RAW_FORMATS[suffixes[-1]], compression
+
+
+def raw_stem(file):
+    '''
+    Query name of a raw tweet dump without format and compression suffixes
+    '''
+    name = Path(str(file)).name
+    fmt, compression = raw_format(name)
+    if compression:
+        name = name[:-len(compression)]
+    return name[:name.rfind(".")]
+
+
+def find_raw_files(input_dir):
+    '''
+    List all raw tweet dumps (csv, tsv, jsonl and compressed versions).
+    Dumps of the same query in several formats would be written to the
+    same outputs, so they raise a ValueError.
+    '''
+    files = sorted(f for f in Path(str(input_dir)).iterdir()
+                   if raw_format(f)[0] is not None)
+
+    queries = {}
+    for f in files:
+        queries.setdefault(raw_stem(f), []).append(f.name)
+    duplicates = ["{} ({})".format(query, ", ".join(names))
+                  for query, names in sorted(queries.items()) if len(names) > 1]
+    if duplicates:
+        raise ValueError("Several raw dumps for the same query: {}".format(
+            "; ".join(duplicates)))
+    return files
+
+
+def open_raw(file):
+    '''
+    Open a raw tweet dump as a text stream, decompressing on the fly
+    '''
+    fmt, compression = raw_format(file)
+    opener = RAW_COMPRESSIONS.get(compression, open)
+    return opener(str(file), "rt", encoding="utf-8", newline='')
+
+
+def iter_raw_tweets(stream, fmt):
+    '''
+    Yield the raw tweet JSON strings contained in a text stream.
+
+    csv dumps have a [tweet_id, tweet] header that must be skipped by the
+    caller, tsv dumps are headerless "tweet_id<TAB>tweet" lines and jsonl
+    dumps hold one tweet per line.
+    '''
+    if fmt == 'csv':
+        for row in csv.reader(stream):
+            yield row[1]
+    elif fmt == 'tsv':
+        for line in stream:
+            parts = line.split("\t", 1)
+            if len(parts) == 2:
+                yield parts[1]
+    elif fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield line
+    else:
+        raise ValueError("Unknown raw tweet format: {}".format(fmt))
+
+
+def iter_batches(iterable, batch_size):
+    '''
+    Group the items of an iterable into lists of `batch_size` items
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
 # Loading individual tweets and manipulate them
@@ -42,16 +151,330 @@ def get_retweet_urls(t):
 
 def get_urls(urls):
     '''
-    Generic function to extract the URLs from the urls sub-object
+    Generic function to extract the URLs from the urls sub-object:
+    [url, expanded_url] of every URL, in tweet order
     '''
     try:
-        urls = [v for (k, v) in urls[0].items()
-                if k in ('url', 'expanded_url')]
-        return list(set(urls))
+        return [[u.get('url'), u.get('expanded_url')] for u in urls]
     except:
         return []
 
 
+# Long format URL tables
+URL_COLUMNS = ['tweet_id', 'url_index', 'url', 'expanded_url']
+
+
+def decode_urls(x):
+    '''
+    [url, expanded_url] pairs of the urls column of a tweet file. Files
+    written by earlier versions hold a flat list of URLs (as JSON or as a
+    Python repr); every URL of those becomes a pair without expanded_url.
+    '''
+    try:
+        urls = json.loads(x)
+    except ValueError:
+        try:
+            urls = ast.literal_eval(x)
+        except (ValueError, SyntaxError):
+            return []
+    if not isinstance(urls, (list, tuple)):
+        return []
+    return [[u, None] if isinstance(u, str) else list(u)[:2] for u in urls]
+
+
+def explode_urls(tweets):
+    '''
+    One row per URL of the `tweets` (tweet_id, urls and venue columns of the
+    tweet files): tweet_id, url_index, url, expanded_url and venue. Every
+    distinct URL list is decoded once.
+    '''
+    tweets = tweets[tweets['urls'].notna()]
+    decoded = {x: decode_urls(x) for x in tweets['urls'].unique()}
+    lists = [decoded[x] for x in tweets['urls'].values]
+    counts = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+
+    pairs = [pair for x in lists for pair in x]
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return pd.DataFrame({
+        'tweet_id': np.repeat(tweets['tweet_id'].values, counts),
+        'url_index': np.arange(counts.sum()) - starts,
+        'url': [pair[0] for pair in pairs],
+        'expanded_url': [pair[1] for pair in pairs],
+        'venue': np.repeat(tweets['venue'].values, counts),
+    }, columns=URL_COLUMNS + ['venue'])
+
+
+def load_url_table(file, venue=None):
+    '''
+    Load the long format URL table, optionally only the URLs of one venue.
+    tweet_id is a string.
+    '''
+    filters = [('venue', '==', venue)] if venue is not None else None
+    df = read_table(file, URL_COLUMNS, filters, index_col=None,
+                    dtype={'tweet_id': str, 'url': str, 'expanded_url': str})
+    if pd.api.types.is_integer_dtype(df['tweet_id']):
+        df['tweet_id'] = ids_to_str(df['tweet_id'])
+    return df
+
+
+# Timestamps
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+
+def _parse_timestamp(x):
+    '''
+    General purpose fallback for timestamps not in the Twitter format
+    '''
+    try:
+        return parse(x, ignoretz=True)
+    except (ValueError, OverflowError, TypeError):
+        return pd.NaT
+
+
+def parse_created_at(values):
+    '''
+    Parse a column of Twitter created_at strings into naive UTC datetimes.
+
+    Values in the fixed Twitter format are parsed in one vectorized call
+    (repeated values are parsed once). The rest fall back to dateutil and
+    are reported; values that can't be parsed at all become NaT.
+    '''
+    values = pd.Series(values, dtype=object)
+    parsed = pd.to_datetime(values, format=TWITTER_TIME_FORMAT,
+                            errors='coerce', cache=True)
+
+    odd = parsed.isna() & values.notna()
+    if odd.any():
+        print("{} timestamps did not match the Twitter format.".format(odd.sum()))
+        parsed[odd] = pd.to_datetime(values[odd].map(_parse_timestamp))
+
+        failed = parsed.isna() & values.notna()
+        if failed.any():
+            print("{} timestamps could not be parsed.".format(failed.sum()))
+    return parsed
+
+
+def to_epoch(values):
+    '''
+    Convert datetimes (without NaT) to int64 epoch seconds
+    '''
+    values = pd.to_datetime(pd.Series(values))
+    return values.values.astype('datetime64[s]').astype(np.int64)
+
+
+def from_epoch(values):
+    '''
+    Convert int64 epoch seconds to datetimes
+    '''
+    return pd.to_datetime(values, unit='s')
+
+
+def epoch_value(x):
+    '''
+    Epoch seconds of a single posted_on value. Files extracted before
+    posted_on was stored as epoch seconds hold date strings. None if the
+    value can't be parsed.
+    '''
+    try:
+        return int(x)
+    except (ValueError, TypeError):
+        parsed = _parse_timestamp(x)
+        return None if pd.isna(parsed) else int(to_epoch([parsed])[0])
+
+
+def time_window(Config):
+    '''
+    [window] start and end (exclusive) as epoch seconds. Missing bounds
+    are open, i.e. the smallest or largest int64.
+    '''
+    start = Config.get('window', 'start', fallback='')
+    end = Config.get('window', 'end', fallback='')
+    return (int(to_epoch([parse(start)])[0]) if start else -2**63,
+            int(to_epoch([parse(end)])[0]) if end else 2**63 - 1)
+
+
+def in_window(posted_on, window):
+    '''
+    Mask of the posted_on values (epoch seconds, date strings in older
+    files) inside a time_window(). Unknown dates are kept.
+    '''
+    min_epoch, max_epoch = window
+    values = pd.Series(posted_on)
+    epochs = pd.to_numeric(values, errors='coerce')
+    legacy = epochs.isna() & values.notna()
+    if legacy.any():
+        epochs[legacy] = values[legacy].map(epoch_value).astype(float)
+    return (epochs.isna() | ((epochs >= min_epoch) & (epochs < max_epoch))).values
+
+
+def window_filters(Config):
+    '''
+    posted_on filters of the [window], for load_tweets and read_table
+    '''
+    min_epoch, max_epoch = time_window(Config)
+    filters = []
+    if min_epoch > -2**63:
+        filters.append(('posted_on', '>=', from_epoch([min_epoch])[0]))
+    if max_epoch < 2**63 - 1:
+        filters.append(('posted_on', '<', from_epoch([max_epoch])[0]))
+    return filters
+
+
+# Flattening batches of raw tweets
+TWEET_COLUMNS = ['tweet_id', 'posted_on', 'user_id', 'retweeted_status',
+                 'quoted_status', 'in_reply_to', 'urls', 'is_truncated']
+
+_decoder = json.JSONDecoder(strict=False)
+_tweet_prefix = re.compile(r'\{"created_at":"([^"]+)","id":\d+,"id_str":"(\d+)"')
+_user_prefix = re.compile(r'"user":\{"id":\d+,"id_str":"(\d+)"')
+_retweet_prefix = re.compile(r'"retweeted_status":\{"created_at":"[^"]*","id":\d+,"id_str":"(\d+)"')
+
+
+def _project_tweet(x):
+    '''
+    Pull the projected fields out of a raw tweet string without decoding
+    the whole object.
+
+    Relies on the compact serialization and key order of the Twitter REST
+    API (created_at, id, id_str, ..., truncated, entities, ...,
+    in_reply_to_status_id_str, ..., user, ..., retweeted_status, ...,
+    quoted_status_id_str, quoted_status). Only the small values at the
+    located positions are decoded. Returns None whenever the layout is not
+    as expected.
+    '''
+    m = _tweet_prefix.match(x)
+    if not m:
+        return None
+    created_at, tweet_id = m.groups()
+
+    # first occurrences are top-level as long as they come in this order
+    truncated = x.find('"truncated":', m.end())
+    entities = x.find('"entities":{', truncated)
+    in_reply_to = x.find('"in_reply_to_status_id_str":', entities)
+    user = x.find('"user":{', in_reply_to)
+    if not -1 < truncated < entities < in_reply_to < user:
+        return None
+    if x.find('"user":{', m.end()) != user:
+        return None
+    is_truncated = x.startswith('true', truncated + 12)
+
+    pos = x.find('"urls":', entities, in_reply_to)
+    if pos < 0:
+        return None
+    urls, _ = _decoder.raw_decode(x, pos + 7)
+
+    in_reply_to, _ = _decoder.raw_decode(x, in_reply_to + 28)
+
+    m = _user_prefix.match(x, user)
+    if not m:
+        return None
+    user_id = m.group(1)
+
+    retweeted_status, quoted_status = None, None
+    quoted = x.find('"quoted_status":{', m.end())
+    pos = x.find('"retweeted_status":{', m.end())
+    if pos >= 0:
+        m = _retweet_prefix.match(x, pos)
+        if not m or -1 < quoted < pos:
+            return None
+        retweeted_status = m.group(1)
+
+        # the retweeted tweet may carry its own quoted_status_id_str, which
+        # can't be told apart from a top-level one without a full decode
+        if '"quoted_status_id_str":' in x:
+            return None
+    else:
+        pos = x.find('"quoted_status_id_str":', m.end())
+        if pos >= 0:
+            quoted_status, _ = _decoder.raw_decode(x, pos + 23)
+
+    return (tweet_id, created_at, user_id, retweeted_status,
+            quoted_status, in_reply_to or None, urls, is_truncated)
+
+
+def _project_tweet_json(tweet):
+    '''
+    Same projection as _project_tweet, for an already decoded Tweet JSON
+    '''
+    if 'retweeted_status' in tweet:
+        retweeted_status = str(tweet['retweeted_status']['id_str'])
+    else:
+        retweeted_status = None
+
+    if 'quoted_status_id_str' in tweet:
+        quoted_status = str(tweet['quoted_status_id_str'])
+    else:
+        quoted_status = None
+
+    try:
+        urls = tweet['entities']['urls']
+    except:
+        urls = []
+
+    return (str(tweet['id_str']), tweet['created_at'], str(tweet['user']['id_str']),
+            retweeted_status, quoted_status,
+            tweet['in_reply_to_status_id_str'] or None, urls, tweet['truncated'])
+
+
+def flatten_tweets(raw_tweets):
+    '''
+    Flatten a batch of raw tweet strings into columns (see TWEET_COLUMNS).
+
+    Uses the projection fast path and falls back to a full json.loads for
+    records it can't handle. Tweets that can't be loaded at all are
+    dropped; the "row" column holds the batch position of every kept tweet.
+    '''
+    rows, kept = [], []
+    for i, x in enumerate(raw_tweets):
+        try:
+            fields = _project_tweet(x)
+        except ValueError:
+            fields = None
+
+        if fields is None:
+            tweet = load_json(x)
+            if not tweet:
+                continue
+            try:
+                fields = _project_tweet_json(tweet)
+            except (KeyError, TypeError):
+                print("Problematic tweet found.")
+                continue
+
+        rows.append(fields)
+        kept.append(i)
+
+    if rows:
+        columns = [list(c) for c in zip(*rows)]
+    else:
+        columns = [[] for _ in TWEET_COLUMNS]
+    columns = dict(zip(TWEET_COLUMNS, columns))
+
+    columns['urls'] = [get_urls(x) for x in columns['urls']]
+    columns['row'] = kept
+
+    # posted_on is stored as epoch seconds, drop tweets without a valid date
+    posted_on = parse_created_at(columns['posted_on'])
+    valid = posted_on.notna().values
+    if not valid.all():
+        print("Dropping {} tweets with invalid timestamps.".format((~valid).sum()))
+        for k, v in columns.items():
+            columns[k] = list(compress(v, valid))
+    columns['posted_on'] = to_epoch(posted_on[valid])
+    return columns
+
+
+def tweet_rows(columns):
+    '''
+    Turn flattened tweet columns into CSV rows of the tweet files
+    '''
+    urls = [json.dumps(x) if len(x) > 0 else None for x in columns['urls']]
+    is_truncated = [str(x) for x in columns['is_truncated']]
+    return zip(columns['tweet_id'], columns['posted_on'], columns['user_id'],
+               columns['retweeted_status'], columns['quoted_status'],
+               columns['in_reply_to'], urls, is_truncated)
+
+
 def load_queries(file):
     '''
     Load file that contains information about the search queries
@@ -60,42 +483,535 @@ def load_queries(file):
     return queries
 
 
-def load_tweets(x):
+# Table storage
+TABLE_FORMATS = ('parquet', 'csv')
+CATEGORICAL_COLUMNS = ['venue', 'venue_short']
+PARQUET_ROW_GROUP_SIZE = 100000
+
+_filter_ops = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda s, v: s.isin(v),
+    'not in': lambda s, v: ~s.isin(v),
+}
+
+
+def table_file(path, fmt):
+    '''
+    File of a stored table, e.g. data/output/twitter_urls -> twitter_urls.parquet
+    '''
+    if fmt not in TABLE_FORMATS:
+        raise ValueError("Unknown table format: {}".format(fmt))
+    return Path(str(path)).with_suffix("." + fmt)
+
+
+def find_table(path):
+    '''
+    Locate a stored table, preferring the columnar version. Falls back to
+    `path` itself for files written before tables had suffixes.
+    '''
+    path = Path(str(path))
+    if path.suffix[1:] in TABLE_FORMATS and path.exists():
+        return path
+    for fmt in TABLE_FORMATS:
+        file = table_file(path, fmt)
+        if file.exists():
+            return file
+    return path
+
+
+def parquet_parts(file):
+    '''
+    Files of a parquet table: the file itself, or the parts of a table
+    stored as a directory (see TableWriter)
+    '''
+    file = Path(str(file))
+    if file.is_dir():
+        return sorted(file.glob("part-*.parquet"))
+    return [file]
+
+
+def save_table(df, path, fmt='parquet'):
+    '''
+    Store a table as parquet (typed, categorical venues) or csv (for publishing)
+    '''
+    file = table_file(path, fmt)
+    if fmt == 'parquet':
+        # keep the index as a regular column so it survives filtered reads
+        df = df.reset_index()
+        for col in CATEGORICAL_COLUMNS:
+            if col in df.columns and df[col].dtype.name != 'category':
+                df[col] = df[col].astype('category')
+        # bounded row groups, so large tables can be read in chunks
+        df.to_parquet(str(file), row_group_size=PARQUET_ROW_GROUP_SIZE)
+    else:
+        df.to_csv(str(file))
+    return file
+
+
+def apply_filters(df, filters):
+    '''
+    Keep rows matching all (column, op, value) filters, e.g.
+    [('venue', '==', 'foxnews'), ('posted_on', '>=', datetime(2017, 1, 1))]
+    '''
+    if not filters:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in filters:
+        if col == df.index.name:
+            values = df.index.to_series()
+        else:
+            values = df[col]
+        mask &= np.asarray(_filter_ops[op](values, value), dtype=bool)
+    return df[mask]
+
+
+def read_table(file, columns=None, filters=None, prepare=None,
+               index_col="id", parse_dates=(), chunksize=100000,
+               pushdown=None, **kwargs):
+    '''
+    Read a stored table, only loading the given columns and rows.
+
+    Parquet files are read column-wise and `filters` are pushed down to
+    pyarrow. CSV files are read in chunks that are filtered right away, so
+    peak memory follows the selected rows. `prepare` converts the dtypes of
+    each chunk before filtering; `pushdown` are the filters with values of
+    the stored types, if they differ from the prepared ones.
+    '''
+    file = find_table(file)
+
+    read_cols = None
+    if columns is not None:
+        read_cols = list(columns)
+        for col, op, value in (filters or []):
+            if col not in read_cols and col != index_col:
+                read_cols.append(col)
+
+    if file.suffix == '.parquet':
+        if read_cols is not None and index_col:
+            read_cols = [index_col] + read_cols
+        if pushdown is None:
+            pushdown = filters
+        df = pd.read_parquet(str(file), columns=read_cols,
+                             filters=[tuple(f) for f in pushdown] if pushdown else None)
+        if index_col in df.columns:
+            df = df.set_index(index_col)
+        if prepare:
+            df = prepare(df)
+        df = apply_filters(df, filters)
+    else:
+        usecols = None
+        if read_cols is not None:
+            usecols = [index_col] + read_cols if index_col else read_cols
+        parse_dates = [c for c in parse_dates if usecols is None or c in usecols]
+
+        chunks = pd.read_csv(str(file), index_col=index_col, usecols=usecols,
+                             parse_dates=parse_dates, chunksize=chunksize, **kwargs)
+        dfs = []
+        for chunk in chunks:
+            if prepare:
+                chunk = prepare(chunk)
+            dfs.append(apply_filters(chunk, filters))
+        df = pd.concat(dfs)
+
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def iter_table(file, columns=None, index_col="id", chunksize=100000, start=0, **kwargs):
+    '''
+    Read a stored table in chunks: parquet tables one row group at a time,
+    CSV files `chunksize` rows at a time. The first `start` rows are skipped.
+    '''
+    file = find_table(file)
+    if file.suffix == '.parquet':
+        import pyarrow.parquet as pq
+
+        for part in parquet_parts(file):
+            parquet = pq.ParquetFile(str(part))
+            read_cols = None
+            if columns is not None:
+                read_cols = list(columns)
+                if index_col and index_col in parquet.schema.names:
+                    read_cols = [index_col] + read_cols
+            for i in range(parquet.num_row_groups):
+                rows = parquet.metadata.row_group(i).num_rows
+                if start >= rows:
+                    start -= rows
+                    continue
+                df = parquet.read_row_group(i, columns=read_cols).to_pandas().iloc[start:]
+                start = 0
+                if index_col in df.columns:
+                    df = df.set_index(index_col)
+                yield df
+    else:
+        usecols = None
+        if columns is not None:
+            usecols = [index_col] + list(columns) if index_col else list(columns)
+        kwargs['parse_dates'] = [c for c in kwargs.get('parse_dates', ())
+                                 if usecols is None or c in usecols]
+        if start:
+            kwargs['skiprows'] = range(1, start + 1)
+        for df in pd.read_csv(str(file), index_col=index_col, usecols=usecols,
+                              chunksize=chunksize, **kwargs):
+            yield df
+
+
+def iter_csv(file, offset=None, chunksize=PARQUET_ROW_GROUP_SIZE, **kwargs):
+    '''
+    Read a CSV file in chunks of `chunksize` rows, starting at byte `offset`
+    (the start of a row), with the column names of its header
+    '''
+    with open(str(file), "rb") as f:
+        names = next(csv.reader([f.readline().decode("utf-8")]))
+        if offset:
+            f.seek(offset)
+        for chunk in pd.read_csv(f, names=names, header=None, chunksize=chunksize, **kwargs):
+            yield chunk
+
+
+def _part_name(i):
+    return "part-{:05d}.parquet".format(i)
+
+
+def _remove(path):
+    if path.is_dir():
+        shutil.rmtree(str(path))
+    elif path.exists():
+        path.unlink()
+
+
+class TableWriter(object):
+    '''
+    Store a table chunk by chunk, in the format of save_table, so tables
+    larger than memory can be written. Rows are numbered on, starting
+    after the rows of the existing table with `append`.
+
+    Parquet tables are stored as a directory of parts that pandas and
+    pyarrow read as one table. Rows go to a temporary file that close()
+    moves into the table: as its only part, or with `append` as a new part
+    next to the existing ones, which are never rewritten. Appended CSV rows
+    are added to the end of the table in close().
+    '''
+    def __init__(self, path, fmt='parquet', append=False):
+        self.file = table_file(path, fmt)
+        self.tmp = self.file.with_name(self.file.name + ".tmp")
+        self.fmt = fmt
+        self.append = False
+        self.rows = 0
+        self.schema = None
+        self.writer = None
+        _remove(self.tmp)
+        if append and self.file.exists():
+            self._count()
+
+    def _count(self):
+        '''
+        Continue after the rows of the existing table, in its schema
+        '''
+        if self.fmt == 'parquet':
+            import pyarrow.parquet as pq
+
+            parts = parquet_parts(self.file)
+            if not parts:
+                return
+            self.rows = sum(pq.ParquetFile(str(part)).metadata.num_rows for part in parts)
+            self.schema = pq.read_schema(str(parts[0]))
+        else:
+            self.rows = sum(len(df) for df in pd.read_csv(str(self.file), usecols=[0],
+                                                          chunksize=PARQUET_ROW_GROUP_SIZE))
+        self.append = True
+
+    def _open(self, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.schema is None:
+            # columns that were empty in the first chunk hold strings
+            fields = [pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                      for f in schema]
+            self.schema = pa.schema(fields, metadata=schema.metadata)
+        self.writer = pq.ParquetWriter(str(self.tmp), self.schema)
+
+    def write(self, df):
+        '''
+        Append the rows of `df`; its index is replaced by the row number
+        '''
+        df = df.reset_index(drop=True)
+        df.index = pd.RangeIndex(self.rows, self.rows + len(df), name="id")
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+
+            df = df.reset_index()
+            for col in CATEGORICAL_COLUMNS:
+                if col in df.columns and df[col].dtype.name != 'category':
+                    df[col] = df[col].astype('category')
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self._open(table.schema)
+            self.writer.write_table(table.cast(self.schema),
+                                    row_group_size=PARQUET_ROW_GROUP_SIZE)
+        else:
+            df.to_csv(str(self.tmp), mode="a", header=self.writer is None and not self.append)
+            self.writer = True
+        self.rows += len(df)
+
+    def close(self):
+        '''
+        Add the rows written to the table, or replace the table with them.
+        Returns the table file, None if no rows were written.
+        '''
+        if self.writer is None:
+            return None
+        if self.fmt == 'parquet':
+            self.writer.close()
+        self.writer = None
+
+        if self.fmt != 'parquet':
+            if self.append:
+                with open(str(self.tmp), "rb") as src, open(str(self.file), "ab") as dst:
+                    shutil.copyfileobj(src, dst, 2**20)
+                self.tmp.unlink()
+            else:
+                os.replace(str(self.tmp), str(self.file))
+        elif self.append:
+            if not self.file.is_dir():
+                # a table stored as a single file becomes the first part
+                single = self.file.with_name(self.file.name + ".single")
+                os.replace(str(self.file), str(single))
+                self.file.mkdir()
+                os.replace(str(single), str(self.file / _part_name(0)))
+            parts = parquet_parts(self.file)
+            os.replace(str(self.tmp), str(self.file / _part_name(len(parts))))
+        else:
+            new = self.file.with_name(self.file.name + ".new")
+            old = self.file.with_name(self.file.name + ".old")
+            _remove(new)
+            _remove(old)
+            new.mkdir()
+            os.replace(str(self.tmp), str(new / _part_name(0)))
+            if self.file.exists():
+                os.replace(str(self.file), str(old))
+            os.replace(str(new), str(self.file))
+            _remove(old)
+        return self.file
+
+    def abort(self):
+        '''
+        Drop the rows written and keep the table as it was
+        '''
+        if self.fmt == 'parquet' and self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        _remove(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Snapshots of raw inputs
+def file_digest(file, block_size=2**20):
+    '''
+    sha256 of a file's contents
+    '''
+    sha = hashlib.sha256()
+    with open(str(file), "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_excel_snapshot(file, sheet_name, snapshot_dir, **kwargs):
+    '''
+    pd.read_excel, backed by a parquet snapshot of the parsed sheet. Snapshots
+    are keyed on the workbook's content hash, the sheet and the read options,
+    so a workbook is only parsed again after it changed.
+    '''
+    file = Path(str(file))
+    key = hashlib.sha256(repr((file_digest(file), sheet_name, sorted(kwargs.items())))
+                         .encode()).hexdigest()[:16]
+    snapshot = Path(str(snapshot_dir)) / "{}-{}".format(file.stem, key)
+
+    if table_file(snapshot, 'parquet').exists():
+        # save_table stores an unnamed index as "index"
+        return read_table(snapshot, index_col=kwargs.get('index_col') or "index")
+
+    df = pd.read_excel(str(file), sheet_name=sheet_name, **kwargs)
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        save_table(df, snapshot, 'parquet')
+    except Exception as e:
+        # e.g. object columns with mixed types; parse again next time
+        print("Could not store snapshot of {}: {}".format(file.name, e))
+        if table_file(snapshot, 'parquet').exists():
+            table_file(snapshot, 'parquet').unlink()
+    return df
+
+
+# Compact tweet tables
+ID_COLUMNS = ['tweet_id', 'user_id', 'retweeted_status', 'quoted_status', 'in_reply_to']
+FLAG_COLUMNS = ['is_truncated', 'refetched']
+TWEET_CATEGORICAL_COLUMNS = ['venue', 'error']
+
+_flags = {'True': True, 'False': False, True: True, False: False}
+
+
+def ids_to_int(values):
+    '''
+    Convert a column of tweet/user IDs to nullable int64 (exact, no float
+    round trip)
+    '''
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values):
+        return values.astype('Int64')
+
+    mask = values.notna().values
+    ids = np.zeros(len(values), dtype=np.int64)
+    ids[mask] = values[mask].astype(str).values.astype(np.int64)
+    return pd.Series(pd.arrays.IntegerArray(ids, ~mask), index=values.index,
+                     name=values.name)
+
+
+def ids_to_str(values):
+    '''
+    Convert a column of nullable int64 IDs back to strings for exporting
+    '''
+    values = pd.Series(values)
+    out = pd.Series(None, index=values.index, name=values.name, dtype=object)
+    mask = values.notna()
+    out[mask] = values[mask].astype(np.int64).astype(str)
+    return out
+
+
+def id_array(values):
+    '''
+    Sorted unique int64 array of the non-null IDs in a column
+    '''
+    values = ids_to_int(values)
+    return np.unique(values[values.notna()].astype(np.int64).values)
+
+
+def compact_tweets(df):
+    '''
+    Memory-compact tweet table: nullable int64 IDs, boolean flags
+    (missing = False) and categorical venue/error
+    '''
+    for col in ID_COLUMNS:
+        if col in df.columns:
+            df[col] = ids_to_int(df[col])
+    for col in FLAG_COLUMNS:
+        if col in df.columns and not pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].map(_flags).fillna(False).astype(bool)
+    for col in TWEET_CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype.name != 'category':
+            df[col] = df[col].astype('category')
+    return df
+
+
+def expand_tweets(df):
+    '''
+    Inverse of compact_tweets for the ID columns, which become strings again
+    '''
+    for col in ID_COLUMNS:
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = ids_to_str(df[col])
+    return df
+
+
+def _prepare_tweets(df, compact=False):
+    '''
+    posted_on is stored as epoch seconds, older files have date strings
+    '''
+    if 'posted_on' in df.columns:
+        if pd.api.types.is_numeric_dtype(df['posted_on']):
+            df['posted_on'] = from_epoch(df['posted_on'])
+        else:
+            df['posted_on'] = pd.to_datetime(df['posted_on'])
+    if compact:
+        return compact_tweets(df)
+    return expand_tweets(df)
+
+
+def _id_filters(filters, int_ids):
+    '''
+    `filters` with the values on the ID columns in `int_ids` as int and
+    on the other ID columns as str
+    '''
+    converted = []
+    for col, op, value in filters or []:
+        if col in ID_COLUMNS:
+            convert = int if col in int_ids else str
+            if op in ('in', 'not in'):
+                value = [convert(v) for v in value]
+            else:
+                value = convert(value)
+        converted.append((col, op, value))
+    return converted
+
+
+def load_tweets(x, columns=None, filters=None, compact=False, **kwargs):
     """
-    Load files containing tweets
+    Load files containing tweets. With `compact` IDs are nullable int64,
+    flags booleans and venue/error categoricals (see compact_tweets).
+    Filters on ID columns take str or int values.
     """
-    df = pd.read_csv(x, index_col="id", parse_dates=['posted_on'],
-                     dtype={
+    pushdown = None
+    if filters:
+        file = find_table(x)
+        if file.suffix == '.parquet':
+            import pyarrow.parquet as pq
+
+            schema = pq.read_schema(str(file))
+            pushdown = _id_filters(filters, [
+                col for col in ID_COLUMNS if col in schema.names and
+                pd.api.types.is_integer_dtype(schema.field(col).type.to_pandas_dtype())])
+        filters = _id_filters(filters, ID_COLUMNS if compact else [])
+
+    df = read_table(x, columns, filters, pushdown=pushdown,
+                    prepare=lambda df: _prepare_tweets(df, compact),
+                    dtype={
         'tweet_id': str,
         'user_id': str,
         'retweeted_status': str,
         'quoted_status': str,
         'in_reply_to': str
-    })
+    }, **kwargs)
     return df
 
 
 # Loading files
-def load_urls(file):
+def load_urls(file, columns=None, filters=None):
     '''
     Load file that contains tweets & urls
     '''
-    df = pd.read_csv(file, index_col="id",
-                     na_values="None",
-                     dtype={'tweet_id': str,
-                            'retweeted_status': str,
-                            'quoted_status': str,
-                            'relevant_url': str,
-                            'cleaned_url': str},
-                     parse_dates=['timestamp'])
+    df = read_table(file, columns, filters,
+                    na_values="None",
+                    dtype={'tweet_id': str,
+                           'retweeted_status': str,
+                           'quoted_status': str,
+                           'relevant_url': str,
+                           'cleaned_url': str},
+                    parse_dates=['timestamp'])
     return df
 
 
-def load_altmetric(file):
+def load_altmetric(file, columns=None, filters=None):
     """
     Load file containing altmetric URLs
     """
-    df = pd.read_csv(file, index_col="id", parse_dates=['posted_on'])
+    df = read_table(file, columns, filters, parse_dates=['posted_on'])
     return df
 
 
@@ -136,6 +1052,60 @@ def relevant_url(url, venue, terms):
     return False
 
 
+class RelevanceMatcher(object):
+    '''
+    `relevant_url` compiled once from the queries: one regex per venue that
+    matches any of its "/search_term/" sections. Works on single URLs and on
+    whole URL columns, and reports which term matched.
+    '''
+    def __init__(self, queries):
+        terms = queries.dropna(subset=['relevant_terms']) \
+            .groupby('venue_short')['relevant_terms'].apply(list)
+        self.terms = terms.to_dict()
+        self.patterns = {}
+        for venue, venue_terms in self.terms.items():
+            # longest first, so the reported term is the most specific one
+            venue_terms = sorted(set(venue_terms), key=len, reverse=True)
+            self.patterns[venue] = re.compile(
+                "/(" + "|".join(re.escape(term) for term in venue_terms) + ")/")
+
+    def match(self, url, venue):
+        '''
+        The search term whose section a URL is in, or None
+        '''
+        if pd.isna(url) or venue not in self.patterns or venue not in url:
+            return None
+        m = self.patterns[venue].search(url)
+        return m.group(1) if m else None
+
+    def relevant(self, url, venue):
+        return self.match(url, venue) is not None
+
+    def match_column(self, urls, venues):
+        '''
+        Matched search term (NaN if not relevant) for a column of URLs.
+        `venues` is a single venue or a column aligned with `urls`.
+        '''
+        urls = pd.Series(urls, dtype=object)
+        if isinstance(venues, str):
+            venues = pd.Series(venues, index=urls.index)
+        else:
+            venues = pd.Series(np.asarray(venues, dtype=object), index=urls.index)
+
+        result = pd.Series(np.nan, index=urls.index, dtype=object)
+        for venue, group in urls.groupby(venues):
+            if venue not in self.patterns:
+                continue
+            group = group.dropna()
+            group = group[group.str.contains(venue, regex=False)]
+            if len(group) > 0:
+                result.loc[group.index] = group.str.extract(self.patterns[venue], expand=False)
+        return result
+
+    def relevant_column(self, urls, venues):
+        return self.match_column(urls, venues).notna()
+
+
 def merge_urls(row):
     '''
     If relevant URL exists return it, otherwise
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Hash join of the relevant Twitter URLs against the Altmetric URLs.
+
+Normalized URLs are hashed together with their venue into uint64 keys once,
+so the join compares integers instead of strings. The Altmetric side is
+small and kept in memory as a hash table; the Twitter side is streamed in
+chunks and aggregated per key. With `partitions` > 1 the per-chunk
+aggregates are spilled into partition files by key (a grace hash join), so
+only one partition of the Twitter URLs is in memory at a time.
+
+Keys that match across the sides are checked against the URL strings, so a
+hash collision never joins two different URLs. Within one side, URLs with
+colliding keys are counted as one; with n distinct URLs that happens with
+a probability of about n^2 / 2^65 (3e-8 for a million URLs).
+'''
+
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def url_keys(venues, urls):
+    '''
+    uint64 hash keys of (venue, normalized URL) pairs
+    '''
+    frame = pd.DataFrame({'venue': np.asarray(venues, dtype=object),
+                          'url': np.asarray(urls, dtype=object)})
+    return pd.util.hash_pandas_object(frame, index=False).values
+
+
+def _id_list(ids):
+    '''
+    Distinct Altmetric IDs, comma separated in order of appearance
+    '''
+    return ",".join(str(int(i)) for i in pd.unique(ids))
+
+
+def _aggregate(chunk):
+    '''
+    venue, url and number of rows per key of a (venue, url) chunk
+    '''
+    chunk = chunk.assign(key=url_keys(chunk['venue'], chunk['url']))
+    return chunk.groupby('key').agg(venue=('venue', 'first'),
+                                    url=('url', 'first'),
+                                    tweet_count=('url', 'size'))
+
+
+class URLJoin(object):
+    '''
+    Join relevant Twitter URLs with Altmetric mentions on (venue, clean URL).
+
+    Feed the Twitter side with `add_tweets(chunk)`, then `overlap()` gives
+    the number of distinct URLs per venue on each side and in both, and
+    `iter_urls()` the URL -> tweet_count/altmetric_ids table.
+    '''
+    def __init__(self, altmetric, partitions=1, spill_dir=None):
+        am = altmetric[altmetric['clean_url'].notna() & (altmetric['relevant'] == True)]
+        am = pd.DataFrame({'venue': am['venue_short'].astype(object).values,
+                           'url': am['clean_url'].values,
+                           'altmetric_id': am['altmetric_id'].values})
+        am = am[am['venue'].notna()]
+        am['key'] = url_keys(am['venue'], am['url'])
+        self.altmetric = am.groupby('key').agg(
+            am_venue=('venue', 'first'),
+            am_url=('url', 'first'),
+            altmetric_ids=('altmetric_id', _id_list))
+
+        self.partitions = partitions
+        self.parts = [[] for _ in range(partitions)]
+        self.spill_dir = None
+        if partitions > 1:
+            self.spill_dir = Path(tempfile.mkdtemp(dir=spill_dir, prefix="urljoin-"))
+        self.venues = {}
+
+    def add_tweets(self, chunk):
+        '''
+        Add a chunk of the Twitter URL table (venue, cleaned_url, relevant)
+        '''
+        chunk = chunk[chunk['cleaned_url'].notna() & (chunk['relevant'] == True)]
+        if len(chunk) == 0:
+            return
+        counts = _aggregate(pd.DataFrame({'venue': chunk['venue'].astype(str).values,
+                                          'url': chunk['cleaned_url'].values}))
+
+        if self.partitions == 1:
+            self.parts[0].append(counts)
+            return
+        partition = counts.index.values % np.uint64(self.partitions)
+        for p, part in counts.groupby(partition):
+            file = self.spill_dir / "part-{}.csv".format(p)
+            part.to_csv(str(file), mode="a", header=not file.exists())
+
+    def _partition(self, p):
+        if self.partitions == 1:
+            parts = self.parts[0]
+        else:
+            file = self.spill_dir / "part-{}.csv".format(p)
+            if not file.exists():
+                return None
+            parts = [pd.read_csv(str(file), dtype={'key': np.uint64, 'venue': str, 'url': str},
+                                 index_col='key')]
+        if not parts:
+            return None
+        df = pd.concat(parts)
+        return df.groupby(level=0).agg(venue=('venue', 'first'),
+                                       url=('url', 'first'),
+                                       tweet_count=('tweet_count', 'sum'))
+
+    def iter_urls(self):
+        '''
+        Yield the joined URL table one partition at a time: venue,
+        relevant_url, tweet_count and altmetric_ids (comma separated,
+        missing for URLs that are only on Twitter)
+        '''
+        self.venues = {}
+        for p in range(self.partitions):
+            df = self._partition(p)
+            if df is None:
+                continue
+            df = df.join(self.altmetric, how='left')
+            # same key, but different URLs
+            collision = df['am_url'].notna() & \
+                ((df['url'] != df['am_url']) | (df['venue'] != df['am_venue']))
+            df.loc[collision, 'altmetric_ids'] = np.nan
+            df = df.drop(columns=['am_venue', 'am_url'])
+
+            in_both = df['altmetric_ids'].notna()
+            for venue, n in df.groupby('venue').size().items():
+                self.venues.setdefault(venue, [0, 0])[0] += int(n)
+            for venue, n in df[in_both].groupby('venue').size().items():
+                self.venues[venue][1] += int(n)
+
+            yield df.rename(columns={'url': 'relevant_url'}).reset_index(drop=True)
+
+    def overlap(self):
+        '''
+        Distinct relevant URLs per venue found by Twitter, Altmetric and both,
+        for the venues with relevant URLs on Twitter. Complete once
+        `iter_urls()` has been consumed.
+        '''
+        df = pd.DataFrame(0, columns=['Twitter', 'Altmetric', 'both'],
+                          index=sorted(self.venues))
+        for venue, (tw, both) in self.venues.items():
+            df.loc[venue, ['Twitter', 'both']] = [tw, both]
+        am = self.altmetric.groupby('am_venue').size()
+        am = am[am.index.isin(df.index)]
+        df.loc[am.index, 'Altmetric'] = am.values
+        df.index.name = "venue"
+        return df.sort_values(by="both")
+
+    def close(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(str(self.spill_dir), ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
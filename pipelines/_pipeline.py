@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Incremental runner for the pipeline stages.
+
+Every stage is one of the existing scripts, run from its own directory. A
+stage declares the files it reads (inputs and code), the config options that
+change its results, the files it writes and the stages it depends on. Its
+fingerprint is a hash over the contents of all of these; a stage only runs
+again if its fingerprint changed since its last successful run or one of its
+outputs is missing. Before a stage runs, its old outputs (and checkpoints)
+are removed, because the scripts skip outputs that already exist.
+
+Inputs listed as `incremental` are append-only record files (raw dumps,
+per-venue tweet and URL files). If only those changed, the old outputs are
+kept and the stage processes just the appended records (see _checkpoint.py).
+Changes to code, config or any other input still rebuild the outputs.
+
+Stages whose dependencies are done run in parallel, so independent branches
+(e.g. the Altmetric and the Twitter stages) don't wait for each other.
+'''
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+
+def _expand(root, pattern):
+    '''
+    Files matching a path, directory or glob pattern relative to `root`
+    '''
+    if any(c in pattern for c in "*?["):
+        paths = root.glob(pattern)
+    else:
+        paths = [root / pattern]
+
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(p for p in path.rglob("*") if p.is_file())
+        elif path.is_file():
+            files.append(path)
+    return sorted(files)
+
+
+class Stage(object):
+    '''
+    One pipeline step. All paths and patterns are relative to the repository
+    root; `config` lists "section" or "section.option" entries and
+    `incremental` the inputs that only ever grow by appended records.
+    '''
+    def __init__(self, name, script, inputs=(), outputs=(), code=(), config=(),
+                 deps=(), keep=(), incremental=()):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.incremental = [pattern for pattern in incremental if pattern in self.inputs]
+        self.outputs = list(outputs)
+        self.code = [script] + list(code)
+        self.config = list(config)
+        self.deps = list(deps)
+        self.keep = set(keep)
+
+    def output_files(self, root):
+        return [f for pattern in self.outputs for f in _expand(root, pattern)
+                if f.name not in self.keep]
+
+    def outputs_exist(self, root):
+        '''
+        Every output without glob characters has to exist, glob patterns
+        have to match at least one file
+        '''
+        return all(_expand(root, pattern) for pattern in self.outputs)
+
+
+class FileHashes(object):
+    '''
+    sha256 of file contents, reused while size and mtime don't change
+    '''
+    def __init__(self, known=None, lock=None):
+        self.known = known if known is not None else {}
+        self.lock = lock or threading.Lock()
+
+    def __call__(self, file):
+        stat = file.stat()
+        key = str(file)
+        with self.lock:
+            entry = self.known.get(key)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        sha = hashlib.sha256()
+        with open(key, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha.update(block)
+        with self.lock:
+            self.known[key] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+
+class PipelineRunner(object):
+    '''
+    Run `stages` in dependency order, skipping stages that are up to date.
+    State (fingerprints and file hashes) is kept in `state_file`, stage
+    output in `log_dir`/<stage>.log.
+    '''
+    def __init__(self, root, stages, Config, state_file, log_dir, workers=2,
+                 python=sys.executable):
+        self.root = Path(str(root))
+        self.stages = {stage.name: stage for stage in stages}
+        self.Config = Config
+        self.state_file = Path(str(state_file))
+        self.log_dir = Path(str(log_dir))
+        self.workers = workers
+        self.python = python
+        self.lock = threading.Lock()
+
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError("{} depends on unknown stage {}".format(stage.name, dep))
+
+        self.state = {'stages': {}, 'files': {}}
+        if self.state_file.exists():
+            with open(str(self.state_file), "r") as f:
+                self.state = json.load(f)
+        self.hashes = FileHashes(self.state['files'], self.lock)
+
+    def _config_values(self, stage):
+        values = []
+        for entry in stage.config:
+            section, _, option = entry.partition(".")
+            if not self.Config.has_section(section):
+                values.append([entry, None])
+            elif option:
+                values.append([entry, self.Config.get(section, option, fallback=None)])
+            else:
+                values.append([entry, sorted(self.Config.items(section))])
+        return values
+
+    def _hash_files(self, patterns):
+        return [[str(f.relative_to(self.root)), self.hashes(f)]
+                for pattern in patterns for f in _expand(self.root, pattern)]
+
+    def fingerprint(self, stage):
+        '''
+        Hashes over the stage's definition (code, config options and regular
+        inputs) and over its incremental inputs
+        '''
+        definition = {'config': self._config_values(stage),
+                      'code': self._hash_files(stage.code),
+                      'inputs': self._hash_files(p for p in stage.inputs
+                                                 if p not in stage.incremental)}
+        data = self._hash_files(stage.incremental)
+        return {'definition': hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest(),
+                'data': hashlib.sha256(json.dumps(data).encode()).hexdigest()}
+
+    def is_stale(self, stage):
+        previous = self.state['stages'].get(stage.name)
+        return previous != self.fingerprint(stage) or not stage.outputs_exist(self.root)
+
+    def _save_state(self):
+        with self.lock:
+            tmp = self.state_file.with_name(self.state_file.name + ".tmp")
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(tmp), "w") as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+            os.replace(str(tmp), str(self.state_file))
+
+    def _clean(self, stage):
+        for f in stage.output_files(self.root):
+            f.unlink()
+            checkpoint = f.with_name(f.name + ".checkpoint")
+            if checkpoint.exists():
+                checkpoint.unlink()
+        # tables stored as a directory of parts keep theirs next to it
+        for pattern in stage.outputs:
+            path = self.root / pattern
+            checkpoint = path.with_name(path.name + ".checkpoint")
+            if path.is_dir() and checkpoint.exists():
+                checkpoint.unlink()
+
+    def run_stage(self, stage, force=False):
+        '''
+        Run one stage if it is stale. Returns "skipped" or "done",
+        raises CalledProcessError if the script fails.
+        '''
+        fingerprint = self.fingerprint(stage)
+        with self.lock:
+            previous = self.state['stages'].get(stage.name)
+        if not force and previous == fingerprint and stage.outputs_exist(self.root):
+            return "skipped"
+
+        if force or not isinstance(previous, dict) or not stage.incremental \
+                or previous['definition'] != fingerprint['definition']:
+            self._clean(stage)
+        script = self.root / stage.script
+        for pattern in stage.outputs:
+            (self.root / pattern).parent.mkdir(parents=True, exist_ok=True)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+
+        with open(str(self.log_dir / (stage.name + ".log")), "w") as log:
+            subprocess.run([self.python, script.name], cwd=str(script.parent),
+                           stdout=log, stderr=subprocess.STDOUT, check=True)
+
+        with self.lock:
+            self.state['stages'][stage.name] = fingerprint
+        self._save_state()
+        return "done"
+
+    def plan(self, targets=None):
+        '''
+        Stages needed for `targets` (default: all) in dependency order
+        '''
+        order, seen = [], set()
+
+        def visit(name, path=()):
+            if name in path:
+                raise ValueError("Cycle in pipeline: {}".format(" -> ".join(path + (name,))))
+            if name in seen:
+                return
+            for dep in self.stages[name].deps:
+                visit(dep, path + (name,))
+            seen.add(name)
+            order.append(self.stages[name])
+
+        for name in targets or self.stages:
+            visit(name)
+        return order
+
+    def run(self, targets=None, force=()):
+        '''
+        Run the stages needed for `targets`, independent stages in parallel.
+        Returns {stage name: "done" | "skipped" | "failed" | "blocked"}.
+        '''
+        stages = self.plan(targets)
+        status = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while len(status) < len(stages):
+                for stage in stages:
+                    if stage.name in status or stage.name in running.values():
+                        continue
+                    deps = [status.get(dep) for dep in stage.deps]
+                    if any(s in ("failed", "blocked") for s in deps):
+                        status[stage.name] = "blocked"
+                        print("{}: blocked by failed dependency".format(stage.name))
+                    elif all(s in ("done", "skipped") for s in deps):
+                        print("{}: starting".format(stage.name))
+                        future = executor.submit(self._timed, stage, stage.name in force)
+                        running[future] = stage.name
+
+                if not running:
+                    continue
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name], elapsed = future.result()
+                        print("{}: {} in {:.1f}s".format(name, status[name], elapsed))
+                    except Exception as e:
+                        status[name] = "failed"
+                        print("{}: failed ({}), see {}".format(
+                            name, e, self.log_dir / (name + ".log")))
+        return status
+
+    def _timed(self, stage, force):
+        start = time.time()
+        result = self.run_stage(stage, force)
+        return result, time.time() - start
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Concurrent URL resolution with a politeness budget per host.
+
+URLs are resolved by a pool of threads, so many requests can be in flight
+at once, while every host still only sees `host_calls` requests per
+`host_period` seconds. Redirects are followed hop by hop with HEAD requests
+(or GET requests that are closed before the body is read), so a resolution
+costs a few hundred bytes instead of the whole article page.
+'''
+
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlparse
+
+import requests
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def url_host(url):
+    '''
+    Host name of a URL, used as the key for rate limiting
+    '''
+    try:
+        return urlparse(url).netloc.lower()
+    except (AttributeError, ValueError):
+        return ""
+
+
+def interleave_hosts(urls):
+    '''
+    Order URLs round-robin by host, so requests to one busy host don't
+    hold up the others
+    '''
+    by_host = OrderedDict()
+    for url in urls:
+        by_host.setdefault(url_host(url), deque()).append(url)
+
+    queues = deque(by_host.values())
+    while queues:
+        queue = queues.popleft()
+        yield queue.popleft()
+        if queue:
+            queues.append(queue)
+
+
+class HostRateLimiter(object):
+    '''
+    Allow at most `calls` requests per `period` seconds to each host
+    '''
+    def __init__(self, calls=1, period=1, clock=time.monotonic, sleep=time.sleep):
+        self.interval = period / calls
+        self.clock = clock
+        self.sleep = sleep
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        '''
+        Reserve the next free slot for `host` and sleep until it starts
+        '''
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+
+def request_headers(url, session, timeout=5):
+    '''
+    Response of a URL without its body. Uses HEAD and falls back to a
+    streamed GET, closed before any of the body is read, for servers that
+    reject HEAD.
+    '''
+    try:
+        resp = session.head(url, allow_redirects=False, timeout=timeout)
+        if resp.status_code < 400:
+            return resp
+    except requests.RequestException:
+        pass
+
+    resp = session.get(url, allow_redirects=False, timeout=timeout, stream=True)
+    resp.close()
+    return resp
+
+
+def follow_redirects(url, session, limiter=None, timeout=5, known=None, max_hops=10):
+    '''
+    Follow the redirect chain of a URL hop by hop, e.g.
+    t.co -> bit.ly -> nyti.ms -> nytimes.com, without downloading bodies.
+
+    `known(url)` can return the already resolved URL of an intermediate hop,
+    which ends the chain without further requests. Returns
+    (resolved_url, error, chain), where chain lists every URL visited.
+    '''
+    chain = [url]
+    try:
+        for i in range(max_hops + 1):
+            if i > 0 and known:
+                r_url = known(url)
+                if r_url:
+                    if r_url != url:
+                        chain.append(r_url)
+                    return r_url, None, chain
+
+            if limiter:
+                limiter.wait(url_host(url))
+            resp = request_headers(url, session, timeout)
+
+            location = resp.headers.get('Location')
+            if resp.status_code not in REDIRECT_CODES or not location:
+                return url, None, chain
+
+            url = urljoin(url, location)
+            chain.append(url)
+        raise requests.TooManyRedirects("Exceeded {} redirects.".format(max_hops))
+    except Exception as e:
+        return None, e, chain
+
+
+class ConcurrentResolver(object):
+    '''
+    Resolve batches of URLs with `workers` threads. Each thread keeps its
+    own session; `resolve`, `session_factory` and the `clock`/`sleep` of
+    the per-host rate limiter can be swapped out, e.g. to run against a
+    local HTTP server.
+
+    Every hop of a resolved chain is remembered, so later URLs that pass
+    through the same hop are resolved without requesting it again.
+    `known(url)` can look up hops resolved in earlier runs.
+    '''
+    def __init__(self, workers=8, host_calls=1, host_period=1, timeout=5,
+                 resolve=follow_redirects, session_factory=requests.Session,
+                 known=None, clock=time.monotonic, sleep=time.sleep):
+        self.limiter = HostRateLimiter(host_calls, host_period, clock, sleep)
+        self.timeout = timeout
+        self.resolve = resolve
+        self.session_factory = session_factory
+        self.known = known
+        self.hops = {}
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = self.session_factory()
+        return self.local.session
+
+    def _known(self, url):
+        if url in self.hops:
+            return self.hops[url]
+        if self.known:
+            return self.known(url)
+        return None
+
+    def _resolve(self, url):
+        r_url, error, chain = self.resolve(url, self._session(), self.limiter,
+                                           self.timeout, known=self._known)
+        if r_url:
+            for hop in chain:
+                self.hops[hop] = r_url
+        return r_url, error, chain
+
+    def resolve_all(self, urls):
+        '''
+        Resolve the unique `urls` concurrently and yield
+        (url, resolved_url, error, chain) as soon as each one finishes
+        '''
+        futures = {self.executor.submit(self._resolve, url): url
+                   for url in interleave_hosts(OrderedDict.fromkeys(urls))}
+        for future in as_completed(futures):
+            r_url, error, chain = future.result()
+            yield futures[future], r_url, error, chain
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
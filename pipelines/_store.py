@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Random-access store for raw tweet JSON.
+
+Every raw dump is copied into a record file of length-prefixed records
+(4 byte little-endian length, then the UTF-8 tweet JSON). An index of
+(tweet_id, file, offset) rows sorted by tweet_id is saved as a numpy array.
+Both are memory-mapped when the store is opened, so looking up a tweet is a
+binary search in the index and a slice of the record file: nothing is read
+but the records asked for.
+
+    store = TweetStore(root / Config.get('storage', 'tweet_store'))
+    store.get("912345678901234567")        # tweet JSON or None
+    store.get_many(ids)                    # in the order of `ids`
+'''
+
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from _helpers import _tweet_prefix, load_json
+
+INDEX_DTYPE = np.dtype([('tweet_id', '<i8'), ('file', '<i4'), ('offset', '<i8')])
+RECORD_SUFFIX = ".records"
+
+_length = struct.Struct("<I")
+
+
+def raw_tweet_id(x):
+    '''
+    tweet_id of a raw tweet JSON string, None if it can't be loaded
+    '''
+    m = _tweet_prefix.match(x)
+    if m:
+        return m.group(2)
+    tweet = load_json(x)
+    if not isinstance(tweet, dict) or 'id_str' not in tweet:
+        return None
+    return str(tweet['id_str'])
+
+
+class TweetStoreWriter(object):
+    '''
+    Build a store in `directory` from raw tweet strings, one record file
+    per `add_file()`. The index is written by `close()`; of tweets that
+    occur in several files the first one is kept.
+    '''
+    def __init__(self, directory):
+        self.directory = Path(str(directory))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.files = []
+        self.index = []
+
+    def add_file(self, name, raw_tweets):
+        '''
+        Copy the raw tweet strings of one dump into the record file `name`.
+        Returns the number of tweets stored and skipped.
+        '''
+        file_no = len(self.files)
+        self.files.append(name + RECORD_SUFFIX)
+        ids, offsets = [], []
+        n_bad = 0
+        with open(str(self.directory / self.files[-1]), "wb") as f:
+            offset = 0
+            for x in raw_tweets:
+                tweet_id = raw_tweet_id(x)
+                if tweet_id is None:
+                    n_bad += 1
+                    continue
+                data = x.rstrip("\r\n").encode("utf-8")
+                f.write(_length.pack(len(data)))
+                f.write(data)
+                ids.append(int(tweet_id))
+                offsets.append(offset)
+                offset += _length.size + len(data)
+
+        index = np.zeros(len(ids), dtype=INDEX_DTYPE)
+        index['tweet_id'] = ids
+        index['file'] = file_no
+        index['offset'] = offsets
+        self.index.append(index)
+        return len(ids), n_bad
+
+    def close(self):
+        index = np.concatenate(self.index) if self.index else np.zeros(0, dtype=INDEX_DTYPE)
+        # stable sort, so duplicates keep the order of the files
+        index = index[np.argsort(index['tweet_id'], kind="stable")]
+        first = np.ones(len(index), dtype=bool)
+        first[1:] = index['tweet_id'][1:] != index['tweet_id'][:-1]
+        np.save(str(self.directory / "index.npy"), index[first])
+        with open(str(self.directory / "files.json"), "w") as f:
+            json.dump(self.files, f)
+        return int(first.sum())
+
+
+class TweetStore(object):
+    '''
+    Read-only access to a store written by TweetStoreWriter
+    '''
+    def __init__(self, directory):
+        self.directory = Path(str(directory))
+        self.index = np.load(str(self.directory / "index.npy"), mmap_mode="r")
+        with open(str(self.directory / "files.json"), "r") as f:
+            self.files = json.load(f)
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _map(self, file_no):
+        if file_no not in self.maps:
+            with open(str(self.directory / self.files[file_no]), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    self.maps[file_no] = b""
+                else:
+                    self.maps[file_no] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[file_no]
+
+    def locate(self, tweet_ids):
+        '''
+        Index positions of `tweet_ids`, -1 for tweets that are not stored
+        '''
+        ids = np.asarray([int(i) for i in tweet_ids], dtype=np.int64)
+        keys = self.index['tweet_id']
+        if len(keys) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+        return np.where(keys[pos] == ids, pos, -1)
+
+    def record(self, pos):
+        '''
+        Raw tweet at index position `pos`, as a memoryview of the record file
+        '''
+        entry = self.index[pos]
+        data = self._map(int(entry['file']))
+        offset = int(entry['offset'])
+        length, = _length.unpack_from(data, offset)
+        start = offset + _length.size
+        return memoryview(data)[start:start + length]
+
+    def get_raw(self, tweet_id):
+        '''
+        Raw tweet JSON (memoryview) or None
+        '''
+        pos = self.locate([tweet_id])[0]
+        return None if pos < 0 else self.record(pos)
+
+    def get(self, tweet_id):
+        '''
+        Tweet JSON or None
+        '''
+        raw = self.get_raw(tweet_id)
+        return None if raw is None else load_json(bytes(raw).decode("utf-8"))
+
+    def get_many(self, tweet_ids):
+        '''
+        Tweet JSONs (None for missing tweets) in the order of `tweet_ids`.
+        Records are read in file order.
+        '''
+        pos = self.locate(tweet_ids)
+        tweets = [None] * len(pos)
+        found = np.flatnonzero(pos >= 0)
+        order = found[np.lexsort((self.index['offset'][pos[found]],
+                                  self.index['file'][pos[found]]))]
+        for i in order:
+            tweets[i] = load_json(bytes(self.record(pos[i])).decode("utf-8"))
+        return tweets
+
+    def close(self):
+        for data in self.maps.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
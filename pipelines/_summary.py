@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Per-venue summaries of the tweets and Twitter URL tables, counted in one
+streaming pass over each table.
+
+Every chunk is reduced to per-venue counts right away, so only one chunk
+and the counters are in memory. Distinct URLs are counted exactly, on
+uint64 hashes of the cleaned URLs that are kept as one sorted array per
+venue. The counters can be saved and merged, so rows appended to the tables
+later are counted on top of them.
+'''
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Columns of the summary tables, as written by the analysis notebooks
+TWEET_COUNTS = ['found tweets', 'original', 'retweets', 'quotes',
+                'retweets/quotes', 'reply']
+URL_COUNTS = ['found tweets', 'found urls', 'relevant urls [%]', 'unique urls']
+# Columns of the refetch error report
+ERROR_COUNTS = ['found tweets', 'refetch errors']
+
+
+class TweetSummary(object):
+    '''
+    Tweets per venue and category. All tweets are counted, so the found
+    tweets are the sum of the categories; tweets that failed to refetch
+    are counted again as refetch errors, which are reported separately.
+    '''
+    columns = ['venue', 'tweet_id', 'retweeted_status', 'quoted_status',
+               'in_reply_to', 'error']
+    counters = TWEET_COUNTS + ['refetch errors']
+
+    def __init__(self):
+        self.counts = pd.DataFrame(columns=self.counters, dtype=np.int64)
+
+    def add(self, chunk):
+        '''
+        Count a chunk of the tweets table (`columns`)
+        '''
+        rt = chunk['retweeted_status'].notna()
+        qt = chunk['quoted_status'].notna()
+        flags = pd.DataFrame({
+            'found tweets': chunk['tweet_id'].notna(),
+            'original': ~rt & ~qt,
+            'retweets': rt & ~qt,
+            'quotes': ~rt & qt,
+            'retweets/quotes': rt & qt,
+            'reply': chunk['in_reply_to'].notna(),
+            'refetch errors': chunk['error'].notna(),
+        })
+        venues = chunk['venue'].astype(str).values
+        self._add_counts(flags.astype(np.int64).groupby(venues).sum())
+
+    def _add_counts(self, counts):
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+
+    def merge(self, other):
+        '''
+        Add the counts of another TweetSummary
+        '''
+        self._add_counts(other.counts)
+
+    def state(self):
+        '''
+        Counts as {venue: {column: n}}, see from_state()
+        '''
+        return {venue: {col: int(n) for col, n in row.items()}
+                for venue, row in self.counts.iterrows()}
+
+    @classmethod
+    def from_state(cls, state):
+        summary = cls()
+        if state:
+            summary.counts = pd.DataFrame.from_dict(state, orient='index') \
+                .reindex(columns=cls.counters).fillna(0).astype(np.int64)
+        return summary
+
+    def table(self, columns=TWEET_COUNTS):
+        df = self.counts[columns].sort_index()
+        df.index.name = "venue"
+        return df
+
+    def errors(self):
+        '''
+        Tweets that failed to refetch per venue
+        '''
+        return self.table(ERROR_COUNTS)
+
+
+class URLSummary(object):
+    '''
+    Found, relevant and distinct cleaned URLs per venue
+    '''
+    columns = ['venue', 'cleaned_url', 'relevant']
+
+    def __init__(self):
+        self.counts = pd.DataFrame(columns=['found urls', 'relevant urls'], dtype=np.int64)
+        self.unique = {}
+
+    def add(self, chunk):
+        '''
+        Count a chunk of the Twitter URL table (`columns`)
+        '''
+        venues = chunk['venue'].astype(str).values
+        counts = pd.DataFrame({'found urls': 1,
+                               'relevant urls': (chunk['relevant'] == True).astype(np.int64)},
+                              index=chunk.index).groupby(venues).sum()
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+
+        urls = chunk['cleaned_url'].notna().values
+        keys = pd.DataFrame({'venue': venues[urls],
+                             'key': pd.util.hash_pandas_object(
+                                 chunk['cleaned_url'][urls], index=False).values})
+        for venue, group in keys.groupby('venue'):
+            known = self.unique.get(venue)
+            new = group['key'].values
+            self.unique[venue] = np.unique(new) if known is None else np.union1d(known, new)
+
+    def save(self, file, **meta):
+        '''
+        Store the counters and `meta` values (npz), see load()
+        '''
+        file = str(file)
+        venues = sorted(self.unique)
+        keys = [self.unique[venue] for venue in venues]
+        with open(file + ".tmp", "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)),
+                     venues=np.array(venues, dtype=str),
+                     lengths=np.array([len(k) for k in keys], dtype=np.int64),
+                     keys=np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64),
+                     count_venues=np.array(self.counts.index, dtype=str),
+                     found=self.counts['found urls'].values.astype(np.int64),
+                     relevant=self.counts['relevant urls'].values.astype(np.int64))
+        os.replace(file + ".tmp", file)
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Counters and meta values saved with save(), empty counters and {}
+        if there are none
+        '''
+        summary = cls()
+        try:
+            data = np.load(str(file))
+        except (OSError, ValueError):
+            return summary, {}
+        with data:
+            keys = np.split(data['keys'], np.cumsum(data['lengths'])[:-1])
+            summary.unique = dict(zip(data['venues'].tolist(), keys))
+            summary.counts = pd.DataFrame({'found urls': data['found'],
+                                           'relevant urls': data['relevant']},
+                                          index=data['count_venues'].tolist())
+            return summary, json.loads(str(data['meta']))
+
+    def table(self, tweets):
+        '''
+        Summary of the URLs, relative to the found tweets per venue of
+        `tweets` (a TweetSummary table)
+        '''
+        df = self.counts.reindex(tweets.index.union(self.counts.index)).fillna(0)
+        df['found tweets'] = tweets['found tweets'].reindex(df.index).fillna(0)
+        df['unique urls'] = pd.Series({venue: len(keys) for venue, keys in self.unique.items()},
+                                      dtype=np.int64).reindex(df.index).fillna(0)
+        df['relevant urls [%]'] = 100 * df['relevant urls'] / df['found tweets'].replace(0, np.nan)
+
+        df = df[URL_COUNTS].fillna(0).round(1)
+        counts = ['found tweets', 'found urls', 'unique urls']
+        df[counts] = df[counts].astype(np.int64)
+        df.index.name = "venue"
+        return df
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Batched tweet lookups through the bulk status lookup endpoint
+(statuses/lookup, up to 100 IDs per call).
+
+The API client is pluggable: anything with a `lookup(ids)` method that
+returns tweet JSONs and exposes the last `rate_limit` works. TweepyClient
+goes through tweepy, HTTPClient talks to the endpoint directly and can be
+pointed at a local mock server.
+'''
+
+import json
+import time
+
+import requests
+
+from _helpers import get_tweet_urls
+
+LOOKUP_BATCH_SIZE = 100
+
+# Error stored for tweets that are missing from a lookup (deleted, protected, ...),
+# in the same format as the errors of single status requests
+MISSING_ERROR = str([{'code': 144, 'message': 'No status found with that ID.'}])
+
+
+class RateLimited(Exception):
+    '''
+    Raised by clients when the rate limit window is exhausted
+    '''
+    def __init__(self, reset=None):
+        super(RateLimited, self).__init__("Rate limit exceeded")
+        self.reset = reset
+
+
+class RateWindow(object):
+    '''
+    Schedule at most `calls` requests per `period` seconds, corrected by the
+    remaining calls and reset time reported by the API
+    '''
+    def __init__(self, calls=900, period=900, clock=time.time, sleep=time.sleep):
+        self.calls = calls
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.remaining = calls
+        self.reset = None
+
+    def wait(self):
+        '''
+        Block until a call is allowed and count it
+        '''
+        now = self.clock()
+        if self.reset is not None and now >= self.reset:
+            self.remaining, self.reset = self.calls, None
+
+        if self.remaining <= 0:
+            delay = (self.reset or now) - now + 1
+            print("Rate limit reached. Sleeping for {:.0f}s".format(delay))
+            self.sleep(delay)
+            now = self.clock()
+            self.remaining, self.reset = self.calls, None
+
+        if self.reset is None:
+            self.reset = now + self.period
+        self.remaining -= 1
+
+    def update(self, remaining, reset):
+        '''
+        Take over the rate limit state reported by the API
+        '''
+        if remaining is not None:
+            self.remaining = remaining
+        if reset is not None:
+            self.reset = reset
+
+
+def _rate_limit(headers):
+    '''
+    (remaining, reset) from the x-rate-limit-* response headers
+    '''
+    try:
+        return (int(headers['x-rate-limit-remaining']),
+                float(headers['x-rate-limit-reset']))
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+
+class HTTPClient(object):
+    '''
+    Plain HTTP client for statuses/lookup. Authentication is left to
+    `auth` (any requests auth object, e.g. OAuth1).
+    '''
+    def __init__(self, base_url="https://api.twitter.com/1.1", session=None,
+                 auth=None, timeout=30):
+        self.url = base_url.rstrip("/") + "/statuses/lookup.json"
+        self.session = session or requests.Session()
+        self.auth = auth
+        self.timeout = timeout
+        self.rate_limit = (None, None)
+
+    def lookup(self, ids):
+        resp = self.session.get(self.url, auth=self.auth, timeout=self.timeout,
+                                params={'id': ",".join(ids), 'tweet_mode': 'extended'})
+        self.rate_limit = _rate_limit(resp.headers)
+        if resp.status_code == 429:
+            raise RateLimited(self.rate_limit[1])
+        resp.raise_for_status()
+        return resp.json()
+
+
+class TweepyClient(object):
+    '''
+    statuses/lookup through a tweepy API object (see HTTPClient)
+    '''
+    def __init__(self, api):
+        self.api = api
+        self.rate_limit = (None, None)
+
+    def lookup(self, ids):
+        import tweepy
+
+        try:
+            statuses = self.api.statuses_lookup(ids, tweet_mode='extended')
+        except tweepy.RateLimitError:
+            raise RateLimited(self._rate_limit()[1])
+        finally:
+            self.rate_limit = self._rate_limit()
+        return [status._json for status in statuses]
+
+    def _rate_limit(self):
+        try:
+            return _rate_limit(self.api.last_response.headers)
+        except AttributeError:
+            return None, None
+
+
+def lookup_tweets(client, ids, window, retries=3):
+    '''
+    Fetch one batch of tweets. Returns {tweet_id: tweet JSON} for the tweets
+    that were found; rate limited calls are retried after the window resets.
+    '''
+    for _ in range(retries):
+        window.wait()
+        try:
+            tweets = client.lookup(ids)
+        except RateLimited as e:
+            window.update(0, e.reset)
+            continue
+        finally:
+            window.update(*client.rate_limit)
+        return {str(t['id_str']): t for t in tweets}
+    raise RateLimited(window.reset)
+
+
+def refetch_batch(client, ids, window):
+    '''
+    Refetch a batch of truncated tweets. Returns
+    {tweet_id: (urls, is_truncated, refetched, error)} for every ID; IDs
+    the lookup doesn't return get MISSING_ERROR. Failed lookups (network
+    errors, RateLimited after the retries) are raised, so the batch isn't
+    committed and is requested again on resume.
+    '''
+    tweets = lookup_tweets(client, ids, window)
+
+    results = {}
+    for tweet_id in ids:
+        if tweet_id not in tweets:
+            results[tweet_id] = (None, True, False, MISSING_ERROR)
+            continue
+
+        urls = get_tweet_urls(tweets[tweet_id])
+        if len(urls) > 0:
+            urls = json.dumps(urls)
+        else:
+            urls = None
+        results[tweet_id] = (urls, False, True, None)
+    return results
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Persistent cache of resolved URLs, shared by the URL resolving stages.
+
+Entries live in an indexed SQLite table, so startup time and memory don't
+depend on how many URLs were ever resolved. Writes are buffered and
+committed in batches. Failed resolutions keep their error and number of
+attempts and are only retried once `retry_after` seconds have passed.
+
+CleanURLCache memoizes clean_url the same way, for (url, venue) pairs. It is
+cleared whenever clean_url or urltools change.
+'''
+
+import csv
+import hashlib
+import inspect
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import urltools
+
+from _helpers import clean_url
+
+# SQLite limits the number of variables per statement
+_chunk_size = 500
+
+
+class URLCache(object):
+    '''
+    short_url -> (resolved_url, error, attempts, last_attempt)
+    '''
+    def __init__(self, file, retry_after=7 * 24 * 3600, max_attempts=5):
+        self.file = Path(str(file))
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self.pending = {}
+
+        # resolver threads look up intermediate hops while the main thread writes
+        self.lock = threading.RLock()
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.file), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS urls (
+                short_url TEXT PRIMARY KEY,
+                resolved_url TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL,
+                last_attempt REAL NOT NULL
+            )""")
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            self.flush()
+            return self.db.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+
+    def _rows(self, urls):
+        '''
+        Cache entries for `urls`, including writes not flushed yet
+        '''
+        with self.lock:
+            urls = list(set(urls))
+            rows = {}
+            for i in range(0, len(urls), _chunk_size):
+                chunk = urls[i:i + _chunk_size]
+                query = "SELECT * FROM urls WHERE short_url IN ({})".format(
+                    ",".join("?" * len(chunk)))
+                for row in self.db.execute(query, chunk):
+                    rows[row[0]] = row[1:]
+
+            for url in urls:
+                if url in self.pending:
+                    resolved_url, error, last_attempt, n = self.pending[url]
+                    attempts = rows[url][2] if url in rows else 0
+                    rows[url] = (resolved_url, error, attempts + n, last_attempt)
+            return rows
+
+    def get(self, url):
+        '''
+        (resolved_url, error) of a cached URL or None
+        '''
+        row = self._rows([url]).get(url)
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def resolved(self, url):
+        '''
+        Resolved URL of a cached URL or None
+        '''
+        return self.lookup([url]).get(url)
+
+    def lookup(self, urls):
+        '''
+        Map the successfully resolved `urls` to their resolved URL
+        '''
+        return {url: row[0] for url, row in self._rows(urls).items() if row[0]}
+
+    def due(self, urls):
+        '''
+        URLs that should be resolved: never tried, or failed less than
+        `max_attempts` times and not retried for `retry_after` seconds
+        '''
+        urls = list(urls)
+        rows = self._rows(urls)
+        now = time.time()
+
+        due = []
+        for url in dict.fromkeys(urls):
+            row = rows.get(url)
+            if row is None:
+                due.append(url)
+            elif not row[0] and row[2] < self.max_attempts \
+                    and now - row[3] >= self.retry_after:
+                due.append(url)
+        return due
+
+    def put(self, url, resolved_url, error=None, timestamp=None):
+        '''
+        Record a resolution attempt. Written to disk on the next flush.
+        '''
+        with self.lock:
+            n = self.pending[url][3] + 1 if url in self.pending else 1
+            if error is not None:
+                error = str(error)
+            self.pending[url] = (resolved_url, error, timestamp or time.time(), n)
+
+    def flush(self):
+        '''
+        Write all buffered attempts in one transaction
+        '''
+        with self.lock:
+            if not self.pending:
+                return
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO urls VALUES (?, NULL, NULL, 0, 0)",
+                    [(url,) for url in self.pending])
+                self.db.executemany(
+                    """UPDATE urls SET resolved_url = ?, error = ?,
+                                       attempts = attempts + ?, last_attempt = ?
+                       WHERE short_url = ?""",
+                    [(r_url, error, n, ts, url)
+                     for url, (r_url, error, ts, n) in self.pending.items()])
+            self.pending = {}
+
+    def import_csv(self, file):
+        '''
+        Import a legacy expanded_urls.csv
+        (index, short_url, resolved_url, error, timestamp)
+        '''
+        with open(str(file), "r") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                _, url, r_url, error, ts = row
+                ts = pd.Timestamp(ts).timestamp() if ts else None
+                self.put(url, r_url or None, error or None, ts)
+        self.flush()
+
+    def to_frame(self):
+        '''
+        All entries as a DataFrame
+        '''
+        with self.lock:
+            self.flush()
+            df = pd.read_sql_query("SELECT * FROM urls", self.db)
+            df['last_attempt'] = pd.to_datetime(df['last_attempt'], unit='s')
+            return df
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def normalizer_version():
+    '''
+    Hash of the source of clean_url and the urltools version, the
+    normalizer the memoized URLs were cleaned with
+    '''
+    try:
+        source = inspect.getsource(clean_url)
+    except (OSError, TypeError):
+        source = repr(clean_url)
+    version = getattr(urltools, '__version__', "")
+    return hashlib.sha256((source + version).encode("utf-8")).hexdigest()
+
+
+class CleanURLCache(object):
+    '''
+    (url, venue) -> clean_url(url, venue), bounded to the `max_entries`
+    most recently used pairs. Columns are cleaned once per unique pair and
+    the results broadcast back to every row. Pairs cleaned with another
+    `version` of the normalizer are dropped when the cache is opened.
+    '''
+    def __init__(self, file, max_entries=1000000, version=None):
+        self.file = Path(str(file))
+        self.max_entries = max_entries
+        self.version = version or normalizer_version()
+        self.rows = self.unique = self.hits = self.misses = 0
+
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.file))
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS clean_urls (
+                url TEXT NOT NULL,
+                venue TEXT NOT NULL,
+                clean_url TEXT,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (url, venue)
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS clean_urls_last_used "
+                        "ON clean_urls (last_used)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )""")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != self.version:
+            self.db.execute("DELETE FROM clean_urls")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.version,))
+        self.db.commit()
+
+    def _lookup(self, pairs):
+        urls = list(set(url for url, _ in pairs))
+        known = {}
+        for i in range(0, len(urls), _chunk_size):
+            chunk = urls[i:i + _chunk_size]
+            query = "SELECT url, venue, clean_url FROM clean_urls WHERE url IN ({})".format(
+                ",".join("?" * len(chunk)))
+            for url, venue, cleaned in self.db.execute(query, chunk):
+                known[(url, venue)] = cleaned
+        return {pair: known[pair] for pair in pairs if pair in known}
+
+    def clean_column(self, urls, venues=None):
+        '''
+        clean_url for a column of URLs. `venues` is a single venue or a
+        column aligned with `urls`.
+        '''
+        frame = pd.DataFrame({'url': pd.Series(urls, dtype=object)})
+        if venues is None or isinstance(venues, str):
+            frame['venue'] = venues or ""
+        else:
+            frame['venue'] = pd.Series(venues, dtype=object).fillna("").values
+
+        pairs = frame[frame.url.notna()].drop_duplicates()
+        pairs = list(zip(pairs.url, pairs.venue))
+        self.rows += len(frame)
+        self.unique += len(pairs)
+
+        cleaned = self._lookup(pairs)
+        missing = [pair for pair in pairs if pair not in cleaned]
+        for url, venue in missing:
+            cleaned[(url, venue)] = clean_url(url, venue or None)
+        self.hits += len(pairs) - len(missing)
+        self.misses += len(missing)
+
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO clean_urls VALUES (?, ?, ?, ?)",
+                [(url, venue, cleaned[(url, venue)], now) for url, venue in pairs])
+
+        result = pd.DataFrame([(url, venue, c) for (url, venue), c in cleaned.items()],
+                              columns=['url', 'venue', 'clean_url'])
+        result = frame.merge(result, on=['url', 'venue'], how='left')['clean_url']
+        result.index = frame.index
+        return result.where(result.notna(), np.nan)
+
+    def stats(self):
+        '''
+        Rows cleaned, unique (url, venue) pairs among them and cache hits
+        '''
+        return {'rows': self.rows, 'unique': self.unique,
+                'hits': self.hits, 'misses': self.misses,
+                'unique_ratio': self.unique / max(self.rows, 1),
+                'hit_rate': self.hits / max(self.unique, 1)}
+
+    def report(self):
+        return ("{rows} URLs, {unique} unique ({unique_ratio:.1%}), "
+                "{hits} cache hits ({hit_rate:.1%}), {misses} normalized").format(**self.stats())
+
+    def close(self):
+        # keep only the most recently used pairs
+        with self.db:
+            self.db.execute("""
+                DELETE FROM clean_urls WHERE rowid NOT IN (
+                    SELECT rowid FROM clean_urls ORDER BY last_used DESC LIMIT ?)""",
+                            (self.max_entries,))
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_url_cache(root, Config):
+    '''
+    Open the URL cache configured in the [resolver] section
+    '''
+    file = root / Config.get('resolver', 'cache', fallback='data/url_cache.sqlite')
+    retry_after = Config.getfloat('resolver', 'retry_after_days', fallback=7) * 24 * 3600
+    max_attempts = Config.getint('resolver', 'max_attempts', fallback=5)
+    return URLCache(file, retry_after=retry_after, max_attempts=max_attempts)
+
+
+def open_clean_cache(root, Config):
+    '''
+    Open the clean_url memo configured in the [resolver] section
+    '''
+    file = root / Config.get('resolver', 'clean_cache', fallback='data/clean_url_cache.sqlite')
+    max_entries = Config.getint('resolver', 'clean_cache_size', fallback=1000000)
+    return CleanURLCache(file, max_entries=max_entries)
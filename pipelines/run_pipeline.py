@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Run the whole pipeline, or the stages needed for some targets, and only
+re-run stages whose inputs, code or config changed.
+
+    extract -> refetch -> relevant_urls -> create_final --.
+                                                         +-> join_urls
+    convert_altmetric -> resolve_altmetric --------------'
+
+    refetch, create_final -> summaries
+
+    tweet_store (random-access copy of the raw dumps)
+
+Stage output goes to the [pipeline] log_dir, fingerprints to its state file.
+'''
+
+import configparser
+from argparse import ArgumentParser
+from pathlib import Path
+
+from _pipeline import PipelineRunner, Stage
+from _helpers import table_file
+
+
+def table_outputs(path, Config):
+    '''
+    Files written by save_table for `path` with the [storage] settings
+    '''
+    table_format = Config.get('storage', 'format', fallback='parquet')
+    outputs = [table_file(path, table_format)]
+    if table_format != 'csv' and Config.getboolean('storage', 'export_csv', fallback=False):
+        outputs.append(table_file(path, 'csv'))
+    return [str(f) for f in outputs]
+
+
+def pipeline_stages(Config):
+    '''
+    The stage DAG, with paths relative to the repository root
+    '''
+    raw_tweets = Config.get('input_files', 'raw_tweets')
+    queries = Config.get('input_files', 'queries')
+    altmetric_raw = Config.get('input_files', 'altmetric_raw')
+    altmetric = Config.get('input_files', 'altmetric')
+    tweets = Config.get('output_files', 'tweets').rstrip("/")
+    tweet_urls = Config.get('output_files', 'tweet_urls')
+    twitter_urls = Config.get('output_files', 'twitter_urls')
+    altmetric_urls = Config.get('output_files', 'altmetric_urls')
+    summary_tweets = Config.get('output_files', 'summary_tweets')
+    summary_urls = Config.get('output_files', 'summary_urls')
+    summary_errors = Config.get('output_files', 'summary_refetch_errors',
+                                fallback='data/output/summary_refetch_errors.csv')
+    summary_altmetric = Config.get('output_files', 'summary_altmetric')
+    news_urls_sample = Config.get('output_files', 'news_urls_sample')
+    tweet_store = Config.get('storage', 'tweet_store', fallback='data/tweet_store/')
+
+    helpers = ["pipelines/_helpers.py"]
+
+    return [
+        Stage("extract", "pipelines/0_json/extract_tweet_data.py",
+              inputs=[raw_tweets],
+              outputs=["pipelines/0_json/temp/*.csv"],
+              code=helpers + ["pipelines/_checkpoint.py"],
+              incremental=[raw_tweets]),
+        Stage("tweet_store", "pipelines/0_json/build_tweet_store.py",
+              inputs=[raw_tweets],
+              outputs=[tweet_store],
+              code=helpers + ["pipelines/_store.py"]),
+        Stage("refetch", "pipelines/1_tweets/refetch_tweets.py",
+              inputs=["pipelines/0_json/temp/*.csv"],
+              outputs=[tweets + "/*.csv"] + table_outputs(tweets, Config) +
+              table_outputs(tweet_urls, Config),
+              code=helpers + ["pipelines/_twitter.py", "pipelines/_checkpoint.py"],
+              # only the settings that change the results; rate limits and
+              # exports don't, and a rebuild requests every tweet again
+              config=["storage.format", "window.start", "window.end", "refetch.api_url"],
+              deps=["extract"],
+              incremental=["pipelines/0_json/temp/*.csv"]),
+        Stage("relevant_urls", "pipelines/2_urls/get_relevant_urls.py",
+              inputs=[tweets + "/*.csv", table_outputs(tweet_urls, Config)[0], queries],
+              outputs=["pipelines/2_urls/temp/*.csv"],
+              code=helpers + ["pipelines/_resolver.py", "pipelines/_url_cache.py",
+                              "pipelines/_checkpoint.py"],
+              # which cached resolutions are used and retried
+              config=["resolver.cache", "resolver.retry_after_days", "resolver.max_attempts"],
+              deps=["refetch"],
+              keep=["expanded_urls.csv"],
+              # the URL table only grows with the tweet files
+              incremental=[tweets + "/*.csv", table_outputs(tweet_urls, Config)[0]]),
+        Stage("create_final", "pipelines/2_urls/create_final.py",
+              inputs=["pipelines/2_urls/temp/*.csv", tweets + "/*.csv", queries],
+              outputs=table_outputs(twitter_urls, Config),
+              code=helpers + ["pipelines/_checkpoint.py", "pipelines/_url_cache.py"],
+              config=["storage.format", "window.start", "window.end"],
+              deps=["relevant_urls"],
+              incremental=["pipelines/2_urls/temp/*.csv", tweets + "/*.csv"]),
+        Stage("summaries", "pipelines/2_urls/create_summaries.py",
+              inputs=[tweets + "/*.csv"] + table_outputs(twitter_urls, Config)[:1],
+              outputs=[summary_tweets, summary_urls, summary_errors],
+              code=helpers + ["pipelines/_summary.py", "pipelines/_checkpoint.py"],
+              config=["storage.format", "window.start", "window.end"],
+              deps=["refetch", "create_final"],
+              # counted on top of the counters of the last run
+              incremental=[tweets + "/*.csv", table_outputs(twitter_urls, Config)[0]]),
+        Stage("convert_altmetric", "pipelines/3_altmetric/convert_raw_data.py",
+              inputs=[altmetric_raw, queries],
+              outputs=[altmetric],
+              code=helpers),
+        Stage("resolve_altmetric", "pipelines/3_altmetric/resolve_shortened_urls.py",
+              inputs=[altmetric, queries],
+              outputs=table_outputs(altmetric_urls, Config),
+              code=helpers + ["pipelines/_resolver.py", "pipelines/_url_cache.py"],
+              config=["storage.format"],
+              deps=["convert_altmetric"]),
+        Stage("join_urls", "pipelines/3_altmetric/join_urls.py",
+              inputs=table_outputs(twitter_urls, Config)[:1] + table_outputs(altmetric_urls, Config)[:1],
+              outputs=[summary_altmetric, news_urls_sample],
+              code=helpers + ["pipelines/_join.py"],
+              config=["join.partitions", "join.sample_size"],
+              deps=["create_final", "resolve_altmetric"]),
+    ]
+
+
+if __name__ == "__main__":
+    root = Path(__file__).resolve().parent.parent
+    Config = configparser.ConfigParser()
+    Config.read(str(root / 'config.cnf'))
+
+    stages = pipeline_stages(Config)
+
+    parser = ArgumentParser(description="Run the pipeline stages that are out of date")
+    parser.add_argument("targets", nargs="*", metavar="STAGE",
+                        help="Stages to bring up to date, with their dependencies (default: all)")
+    parser.add_argument("-f", "--force", action="append", default=[], metavar="STAGE",
+                        help="Re-run a stage even if it is up to date")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Only list the stages that are out of date")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of stages to run in parallel (default from config)")
+    args = parser.parse_args()
+
+    names = [stage.name for stage in stages]
+    for name in args.targets + args.force:
+        if name not in names:
+            parser.error("unknown stage {} (choose from {})".format(name, ", ".join(names)))
+
+    runner = PipelineRunner(
+        root, stages, Config,
+        state_file=root / Config.get('pipeline', 'state', fallback='data/pipeline/state.json'),
+        log_dir=root / Config.get('pipeline', 'log_dir', fallback='data/pipeline/logs/'),
+        workers=args.workers or Config.getint('pipeline', 'workers', fallback=2))
+
+    if args.dry_run:
+        # staleness of later stages is only known once earlier stages ran
+        for stage in runner.plan(args.targets):
+            state = "out of date" if runner.is_stale(stage) else "up to date"
+            print("{}: {}".format(stage.name, state))
+    else:
+        status = runner.run(args.targets, force=args.force)
+        if any(s in ("failed", "blocked") for s in status.values()):
+            raise SystemExit(1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Shared fixtures. The pipeline modules are imported from pipelines/, as the
+stage scripts do, and `serve` runs local stand-ins for remote servers.
+'''
+
+import sys
+import threading
+from http.server import HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeClock(object):
+    '''
+    Clock for the `clock`/`sleep` hooks: sleeping moves the time forward
+    '''
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def serve():
+    '''
+    serve(handler class) starts a local HTTP server and returns its port
+    '''
+    servers = []
+
+    def start(handler):
+        server = LocalServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server.server_port
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
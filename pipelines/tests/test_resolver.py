@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Concurrent URL resolution against a local redirect server
+'''
+
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from _resolver import ConcurrentResolver, HostRateLimiter
+
+
+def redirect_handler(requests):
+    '''
+    /s/<n> redirects to /page/<n>, which is a page. Records the (host,
+    path) of every request.
+    '''
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            with lock:
+                requests.append((self.headers['Host'], self.path))
+            if self.path.startswith("/s/"):
+                self.send_response(302)
+                self.send_header("Location", "/page/" + self.path.split("/")[-1])
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = do_HEAD
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def test_redirects_are_followed(serve):
+    requests = []
+    port = serve(redirect_handler(requests))
+    urls = ["http://127.0.0.1:{}/s/{}".format(port, i) for i in range(3)]
+
+    with ConcurrentResolver(workers=3, host_calls=100, host_period=1) as resolver:
+        results = {url: (r_url, error, chain)
+                   for url, r_url, error, chain in resolver.resolve_all(urls)}
+
+    for i, url in enumerate(urls):
+        page = "http://127.0.0.1:{}/page/{}".format(port, i)
+        assert results[url] == (page, None, [url, page])
+    assert len(requests) == 6
+
+
+def test_requests_are_spaced_per_host(serve):
+    requests = []
+    port = serve(redirect_handler(requests))
+    # two hosts for the same server
+    urls = ["http://{}:{}/page/{}".format(host, port, i)
+            for host in ("127.0.0.1", "localhost") for i in range(3)]
+
+    # with the clock standing still, every request sleeps until its slot
+    sleeps = []
+    with ConcurrentResolver(workers=6, host_calls=2, host_period=1,
+                            clock=lambda: 0.0, sleep=sleeps.append) as resolver:
+        results = list(resolver.resolve_all(urls))
+
+    assert all(error is None for _, _, error, _ in results)
+    assert len(requests) == 6
+    # slots 0, 0.5 and 1 on each host, instead of one queue for both
+    assert sorted(sleeps) == [0.5, 0.5, 1.0, 1.0]
+
+
+def test_limiter_frees_slots_over_time(clock):
+    limiter = HostRateLimiter(calls=2, period=1, clock=clock, sleep=clock.sleep)
+    limiter.wait("a")
+    limiter.wait("a")
+    limiter.wait("b")
+    assert clock.sleeps == [0.5]
+
+    clock.now += 10
+    limiter.wait("a")
+    assert clock.sleeps == [0.5]
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Batched tweet lookups against a local stand-in for statuses/lookup
+'''
+
+import json
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from _twitter import (LOOKUP_BATCH_SIZE, MISSING_ERROR, HTTPClient, RateLimited,
+                      RateWindow, lookup_tweets, refetch_batch)
+
+
+def lookup_handler(calls, limited=0, reset=None, remaining=None):
+    '''
+    statuses/lookup that records the IDs of every call, leaves out the
+    tweets with IDs divisible by 7 and answers the first `limited` calls
+    with 429 until `reset`
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            ids = parse_qs(urlparse(self.path).query)['id'][0].split(",")
+            calls.append(ids)
+            if len(calls) <= limited:
+                self.send_response(429)
+                self.send_header("x-rate-limit-remaining", "0")
+                self.send_header("x-rate-limit-reset", str(reset))
+                self.end_headers()
+                return
+
+            tweets = [{'id_str': tweet_id,
+                       'entities': {'urls': [{'url': "https://t.co/" + tweet_id,
+                                              'expanded_url': "http://example.com/" + tweet_id}]}}
+                      for tweet_id in ids if int(tweet_id) % 7]
+            body = json.dumps(tweets).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if remaining is not None:
+                self.send_header("x-rate-limit-remaining", str(remaining))
+                self.send_header("x-rate-limit-reset", str(reset))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def client_for(port):
+    return HTTPClient("http://127.0.0.1:{}".format(port), timeout=5)
+
+
+def test_batch_is_one_lookup(serve, clock):
+    calls = []
+    client = client_for(serve(lookup_handler(calls)))
+    ids = [str(i) for i in range(1, LOOKUP_BATCH_SIZE + 1)]
+
+    results = refetch_batch(client, ids, RateWindow(clock=clock, sleep=clock.sleep))
+
+    assert calls == [ids]
+    assert list(results) == ids
+
+
+def test_missing_tweets_get_missing_error(serve, clock):
+    client = client_for(serve(lookup_handler([])))
+    results = refetch_batch(client, ["6", "7", "14"], RateWindow(clock=clock, sleep=clock.sleep))
+
+    urls, is_truncated, refetched, error = results["6"]
+    assert json.loads(urls) == [["https://t.co/6", "http://example.com/6"]]
+    assert (is_truncated, refetched, error) == (False, True, None)
+    for tweet_id in ["7", "14"]:
+        assert results[tweet_id] == (None, True, False, MISSING_ERROR)
+
+
+def test_rate_window_sleeps_until_reset(clock):
+    window = RateWindow(calls=2, period=60, clock=clock, sleep=clock.sleep)
+    window.wait()
+    clock.now += 10
+    window.wait()
+    assert clock.sleeps == []
+
+    # the window started with the first call and resets 60s later
+    window.wait()
+    assert clock.sleeps == [51]
+    assert window.remaining == 1
+
+
+def test_rate_window_follows_api_headers(serve, clock):
+    client = client_for(serve(lookup_handler([], remaining=0, reset=clock.now + 30)))
+    window = RateWindow(calls=900, period=900, clock=clock, sleep=clock.sleep)
+
+    lookup_tweets(client, ["1"], window)
+    assert clock.sleeps == []
+    lookup_tweets(client, ["2"], window)
+    assert clock.sleeps == [31]
+
+
+def test_rate_limited_lookup_is_retried_after_reset(serve, clock):
+    calls = []
+    client = client_for(serve(lookup_handler(calls, limited=1, reset=clock.now + 120)))
+    window = RateWindow(clock=clock, sleep=clock.sleep)
+
+    tweets = lookup_tweets(client, ["1", "2"], window)
+
+    assert sorted(tweets) == ["1", "2"]
+    assert calls == [["1", "2"], ["1", "2"]]
+    assert clock.sleeps == [121]
+
+
+def test_failed_batch_is_raised(serve, clock):
+    calls = []
+    client = client_for(serve(lookup_handler(calls, limited=3, reset=clock.now + 5)))
+    window = RateWindow(clock=clock, sleep=clock.sleep)
+
+    with pytest.raises(RateLimited):
+        refetch_batch(client, ["1"], window)
+    assert len(calls) == 3